@@ -9,7 +9,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
-from scipy.stats import poisson
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.manifold import MDS, TSNE, Isomap
 from sklearn.metrics import pairwise_distances
@@ -125,8 +124,8 @@ def sort_mg(mg, level_names):
     total_sort_by = []
     for sc in sort_class:
         for co in class_order:
-            class_value = meta.groupby(sc)[co].mean()
-            meta[f"{sc}_{co}_order"] = meta[sc].map(class_value)
+            class_value = meta.groupby(sc, observed=True)[co].mean()
+            meta[f"{sc}_{co}_order"] = meta[sc].map(class_value).astype(float)
             total_sort_by.append(f"{sc}_{co}_order")
         total_sort_by.append(sc)
     mg = mg.sort_values(total_sort_by, ascending=False)
@@ -138,7 +137,9 @@ def get_mid_map(full_meta, lowest_level=7):
     meta = full_meta[full_meta["hemisphere"] == "L"].copy()
 
     level = lowest_level
-    sizes = meta.groupby([f"lvl{level}_labels", "merge_class"], sort=False).size()
+    sizes = meta.groupby(
+        [f"lvl{level}_labels", "merge_class"], sort=False, observed=True
+    ).size()
 
     uni_labels = sizes.index.unique(0)
 
@@ -159,7 +160,9 @@ def get_mid_map(full_meta, lowest_level=7):
     meta = full_meta[full_meta["hemisphere"] == "R"].copy()
 
     level = lowest_level
-    sizes = meta.groupby([f"lvl{level}_labels", "merge_class"], sort=False).size()
+    sizes = meta.groupby(
+        [f"lvl{level}_labels", "merge_class"], sort=False, observed=True
+    ).size()
 
     # uni_labels = np.unique(labels)
     uni_labels = sizes.index.unique(0)
@@ -213,7 +216,9 @@ def draw_bar_dendrogram(meta, ax, first_mid_map):
     line_kws = dict(linewidth=1, color="k")
     for level in np.arange(lowest_level + 1)[::-1]:
         x = level
-        sizes = meta.groupby([f"lvl{level}_labels", "merge_class"], sort=False).size()
+        sizes = meta.groupby(
+            [f"lvl{level}_labels", "merge_class"], sort=False, observed=True
+        ).size()
 
         uni_labels = sizes.index.unique(0)  # these need to be in the right order
 
@@ -256,24 +261,37 @@ def draw_bar_dendrogram(meta, ax, first_mid_map):
         last_mid_map = dict(zip(uni_labels, mids))
 
 
+def binary_poisson_score(adj, log_p, sum_p, block_size=512):
+    # for binary adj, log(k!) = 0 so the poisson log pmf is k * log(p) - p
+    # accumulate over row blocks to avoid an N x N temporary
+    score = 0.0
+    for start in range(0, adj.shape[0], block_size):
+        stop = start + block_size
+        score += (adj[start:stop] * log_p[start:stop]).sum()
+    return score - sum_p
+
+
 def calc_model_liks(adj, meta, lp_inds, rp_inds, n_levels=10):
     rows = []
+    left_adj = binarize(adj[np.ix_(lp_inds, lp_inds)])
+    left_adj = remove_loops(left_adj)
+    right_adj = binarize(adj[np.ix_(rp_inds, rp_inds)])
+    right_adj = remove_loops(right_adj)
+    left_sum = left_adj.sum()
+    right_sum = right_adj.sum()
     for l in range(n_levels + 1):
-        labels = meta[f"lvl{l}_labels"].values
-        left_adj = binarize(adj[np.ix_(lp_inds, lp_inds)])
-        left_adj = remove_loops(left_adj)
-        right_adj = binarize(adj[np.ix_(rp_inds, rp_inds)])
-        right_adj = remove_loops(right_adj)
+        inv, uni_labels = pd.factorize(meta[f"lvl{l}_labels"])
         for model, name in zip([DCSBMEstimator, SBMEstimator], ["DCSBM", "SBM"]):
             estimator = model(directed=True, loops=False)
-            uni_labels, inv = np.unique(labels, return_inverse=True)
             estimator.fit(left_adj, inv[lp_inds])
             train_left_p = estimator.p_mat_
             train_left_p[train_left_p == 0] = 1 / train_left_p.size
+            log_p = np.log(train_left_p)
+            sum_p = train_left_p.sum()
 
             n_params = estimator._n_parameters() + len(uni_labels)
 
-            score = poisson.logpmf(left_adj, train_left_p).sum()
+            score = binary_poisson_score(left_adj, log_p, sum_p)
             rows.append(
                 dict(
                     train_side="Left",
@@ -283,10 +301,10 @@ def calc_model_liks(adj, meta, lp_inds, rp_inds, n_levels=10):
                     level=l,
                     model=name,
                     n_params=n_params,
-                    norm_score=score / left_adj.sum(),
+                    norm_score=score / left_sum,
                 )
             )
-            score = poisson.logpmf(right_adj, train_left_p).sum()
+            score = binary_poisson_score(right_adj, log_p, sum_p)
             rows.append(
                 dict(
                     train_side="Left",
@@ -296,18 +314,21 @@ def calc_model_liks(adj, meta, lp_inds, rp_inds, n_levels=10):
                     level=l,
                     model=name,
                     n_params=n_params,
-                    norm_score=score / right_adj.sum(),
+                    norm_score=score / right_sum,
                 )
             )
+            del estimator, train_left_p, log_p
 
             estimator = model(directed=True, loops=False)
             estimator.fit(right_adj, inv[rp_inds])
             train_right_p = estimator.p_mat_
             train_right_p[train_right_p == 0] = 1 / train_right_p.size
+            log_p = np.log(train_right_p)
+            sum_p = train_right_p.sum()
 
             n_params = estimator._n_parameters() + len(uni_labels)
 
-            score = poisson.logpmf(left_adj, train_right_p).sum()
+            score = binary_poisson_score(left_adj, log_p, sum_p)
             rows.append(
                 dict(
                     train_side="Right",
@@ -317,10 +338,10 @@ def calc_model_liks(adj, meta, lp_inds, rp_inds, n_levels=10):
                     level=l,
                     model=name,
                     n_params=n_params,
-                    norm_score=score / left_adj.sum(),
+                    norm_score=score / left_sum,
                 )
             )
-            score = poisson.logpmf(right_adj, train_right_p).sum()
+            score = binary_poisson_score(right_adj, log_p, sum_p)
             rows.append(
                 dict(
                     train_side="Right",
@@ -330,9 +351,10 @@ def calc_model_liks(adj, meta, lp_inds, rp_inds, n_levels=10):
                     level=l,
                     model=name,
                     n_params=n_params,
-                    norm_score=score / right_adj.sum(),
+                    norm_score=score / right_sum,
                 )
             )
+            del estimator, train_right_p, log_p
     return pd.DataFrame(rows)
 
 
@@ -355,17 +377,20 @@ def calc_pairedness(pred_labels, lp_inds, rp_inds):
 
 
 def plot_pairedness(meta, lp_inds, rp_inds, ax, n_levels=10, n_shuffles=10):
-    rows = []
+    dfs = []
     for l in range(n_levels + 1):
-        pred_labels = meta[f"lvl{l}_labels"].values.copy()
+        pred_labels = pd.factorize(meta[f"lvl{l}_labels"])[0]
         p_same = calc_pairedness(pred_labels, lp_inds, rp_inds)
-        rows.append(dict(p_same_cluster=p_same, labels="True", level=l))
-        # look at random chance
-        for i in range(n_shuffles):
-            np.random.shuffle(pred_labels)
-            p_same = calc_pairedness(pred_labels, lp_inds, rp_inds)
-            rows.append(dict(p_same_cluster=p_same, labels="Shuffled", level=l))
-    plot_df = pd.DataFrame(rows)
+        dfs.append(pd.DataFrame(dict(p_same_cluster=[p_same], labels="True", level=l)))
+        # look at random chance, one row of `perms` per shuffle
+        perms = np.argsort(np.random.rand(n_shuffles, len(pred_labels)), axis=1)
+        shuffled = pred_labels[perms]
+        p_same = (shuffled[:, lp_inds] == shuffled[:, rp_inds]).mean(axis=1)
+        shuffle_df = pd.DataFrame(
+            dict(p_same_cluster=p_same, labels="Shuffled", level=l)
+        )
+        dfs.append(shuffle_df)
+    plot_df = pd.concat(dfs, ignore_index=True)
 
     sns.lineplot(
         data=plot_df,
@@ -394,7 +419,7 @@ def plot_model_liks(adj, meta, lp_inds, rp_inds, ax, n_levels=10, model_name="DC
 
 
 def plot_color_labels(full_meta, ax):
-    full_sizes = full_meta.groupby(["merge_class"], sort=False).size()
+    full_sizes = full_meta.groupby(["merge_class"], sort=False, observed=True).size()
     uni_class = full_sizes.index.unique()
     counts = full_sizes.values
     count_map = dict(zip(uni_class, counts))
@@ -460,23 +485,26 @@ def plot_double_dendrogram(full_meta, axs):
 def plot_adjacencies(full_mg, axs):
     sns.set_palette("deep", 1)
     model = DCSBMEstimator
+    adj = binarize(full_mg.adj)
+    # a single rasterized mesh per panel, rather than one marker per edge
+    plot_kws = dict(
+        plot_type="heatmap",
+        cmap="binary",
+        center=None,
+        cbar=False,
+        rasterized=True,
+        item_order=["merge_class_sf_order", "merge_class", "sf"],
+        class_order="sf",
+        meta=full_mg.meta,
+        palette=CLASS_COLOR_DICT,
+        colors="merge_class",
+        ticks=False,
+        gridline_kws=dict(linewidth=0.2, color="grey", linestyle="--"),
+    )
     for level in np.arange(lowest_level + 1):
         ax = axs[0, level]
-        adj = binarize(full_mg.adj)
-        _, _, top, _ = adjplot(
-            adj,
-            ax=ax,
-            plot_type="scattermap",
-            sizes=(0.5, 0.5),
-            sort_class=["hemisphere"] + level_names[: level + 1],
-            item_order=["merge_class_sf_order", "merge_class", "sf"],
-            class_order="sf",
-            meta=full_mg.meta,
-            palette=CLASS_COLOR_DICT,
-            colors="merge_class",
-            ticks=False,
-            gridline_kws=dict(linewidth=0.2, color="grey", linestyle="--"),
-        )
+        sort_class = ["hemisphere"] + level_names[: level + 1]
+        _, _, top, _ = adjplot(adj, ax=ax, sort_class=sort_class, **plot_kws)
         top.set_title(f"Level {level} - Data")
 
         labels = full_mg.meta[f"lvl{level}_labels_side"]
@@ -485,21 +513,9 @@ def plot_adjacencies(full_mg, axs):
         estimator.fit(adj, inv)
         sample_adj = np.squeeze(estimator.sample())
         ax = axs[1, level]
-        _, _, top, _ = adjplot(
-            sample_adj,
-            ax=ax,
-            plot_type="scattermap",
-            sizes=(0.5, 0.5),
-            sort_class=["hemisphere"] + level_names[: level + 1],
-            item_order=["merge_class_sf_order", "merge_class", "sf"],
-            class_order="sf",
-            meta=full_mg.meta,
-            palette=CLASS_COLOR_DICT,
-            colors="merge_class",
-            ticks=False,
-            gridline_kws=dict(linewidth=0.2, color="grey", linestyle="--"),
-        )
+        _, _, top, _ = adjplot(sample_adj, ax=ax, sort_class=sort_class, **plot_kws)
         top.set_title(f"Level {level} - DCSBM sample")
+        del estimator, sample_adj
 
 
 # %% [markdown]
@@ -507,6 +523,9 @@ def plot_adjacencies(full_mg, axs):
 # load data
 full_meta = readcsv("meta" + basename, foldername=exp, index_col=0)
 full_meta["lvl0_labels"] = full_meta["lvl0_labels"].astype(str)
+# categorical codes make the many groupbys below much cheaper than hashing strings
+for c in level_names + ["merge_class", "hemisphere"]:
+    full_meta[c] = full_meta[c].astype("category")
 full_adj = readcsv("adj" + basename, foldername=exp, index_col=0)
 full_mg = MetaGraph(full_adj.values, full_meta)
 
@@ -612,5 +631,6 @@ plt.tight_layout()
 if permute_prop > 0:
     basename += f"-permute={permute_prop}"
 stashfig(f"megafig-lowest={lowest_level}" + basename)
-plt.close()
+fig.clf()
+plt.close("all")
 
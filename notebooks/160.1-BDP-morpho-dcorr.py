@@ -12,13 +12,12 @@ from matplotlib.patches import Circle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 from scipy.integrate import tplquad
-from scipy.special import comb
-from scipy.stats import gaussian_kde
-from sklearn.metrics import pairwise_distances
+from scipy.spatial.distance import cdist, pdist, squareform
+from scipy.stats import chi2, gaussian_kde
 
 import pymaid
 from graspy.utils import pass_to_ranks
-from hyppo.ksample import KSample
+from hyppo.independence import Dcorr
 from src.data import load_metagraph
 from src.graph import MetaGraph, preprocess
 from src.hierarchy import signal_flow
@@ -36,6 +35,9 @@ from src.visualization import (
     stacked_barplot,
 )
 from joblib import Parallel, delayed
+from numba import njit, types
+from numba.typed import Dict
+from threadpoolctl import threadpool_limits
 
 np.random.seed(8888)
 
@@ -87,52 +89,177 @@ compartment = "dendrite"
 direction = "postsynaptic"
 max_samples = 500
 n_subsamples = 48 * 2
+max_full_samples = 2000
+max_bbox_gap = 20000  # nm, pairs of classes farther apart than this are not tested
 method = "subsample"
 
 
-def filter_connectors(connectors, ids, direction, compartment):
-    label_connectors = connectors[connectors[f"{direction}_to"].isin(ids)]
-    label_connectors = label_connectors[
-        label_connectors[f"{direction}_type"] == compartment
-    ]
-    label_connectors = label_connectors[
-        ~label_connectors["connector_id"].duplicated(keep="first")
-    ]
-    return label_connectors
+def group_connectors(connectors, direction, compartment):
+    """Connectors onto `compartment`, and their row positions for each neuron"""
+    connectors = connectors[connectors[f"{direction}_type"] == compartment]
+    groups = connectors.groupby(f"{direction}_to").indices
+    return connectors, groups
+
+
+@njit(cache=True)
+def _first_occurrences(values):
+    """Positions of the first occurrence of each value, in order"""
+    seen = Dict.empty(key_type=types.int64, value_type=types.boolean)
+    keep = np.empty(len(values), dtype=np.int64)
+    n_keep = 0
+    for i in range(len(values)):
+        if values[i] not in seen:
+            seen[values[i]] = True
+            keep[n_keep] = i
+            n_keep += 1
+    return keep[:n_keep]
+
+
+def filter_connectors(connectors, groups, ids):
+    inds = [groups[i] for i in ids if i in groups]
+    if len(inds) == 0:
+        return connectors.iloc[[]]
+    inds = np.sort(np.concatenate(inds))  # keep the original row order
+    connector_ids = connectors["connector_id"].values[inds].astype(np.int64)
+    inds = inds[_first_occurrences(connector_ids)]
+    return connectors.iloc[inds]
+
+
+def bbox_gap(bbox1, bbox2):
+    """Smallest distance between two axis-aligned (mins, maxs) bounding boxes"""
+    gaps = np.maximum(bbox1[0] - bbox2[1], bbox2[0] - bbox1[1])
+    return np.linalg.norm(np.maximum(gaps, 0))
 
 
 def euclidean(x):
     """Default euclidean distance function calculation"""
-    return pairwise_distances(X=x, metric="euclidean", n_jobs=-1)
+    return squareform(pdist(x, metric="euclidean"))
+
+
+def run_dcorr(data1, data2, dist1=None, dist2=None):
+    """Dcorr two-sample test, reusing within-sample distances if given"""
+    if dist1 is None:
+        dist1 = euclidean(data1)
+    if dist2 is None:
+        dist2 = euclidean(data2)
+    cross_dist = cdist(data1, data2, metric="euclidean")
+    distx = np.block([[dist1, cross_dist], [cross_dist.T, dist2]])
+    # same as the k-sample transform: labels are equidistant across samples
+    labels = np.repeat([0, 1], [len(data1), len(data2)])
+    disty = (labels[:, np.newaxis] != labels[np.newaxis, :]).astype(float)
+    # pairs already run in parallel, so keep BLAS from oversubscribing cores
+    with threadpool_limits(limits=1):
+        stat, pval = Dcorr(compute_distance=None).test(distx, disty, auto=True)
+    return stat, pval
 
 
-def run_dcorr(data1, data2):
-    ksamp = KSample("Dcorr", compute_distance=euclidean)
-    stat, pval = ksamp.test(data1, data2, auto=True, workers=-1)
+def _dist_row_sums(z):
+    """Row sums of |z_i - z_j| for 1-D `z` in O(n log n) via sorting"""
+    n = len(z)
+    order = np.argsort(z, kind="mergesort")
+    z_sorted = z[order]
+    ranks = np.arange(n)
+    csum = np.cumsum(z_sorted)
+    below = z_sorted * ranks - (csum - z_sorted)
+    above = (csum[-1] - csum) - z_sorted * (n - 1 - ranks)
+    row_sums = np.empty(n)
+    row_sums[order] = below + above
+    return row_sums
+
+
+def fast_dcorr_1d(data1, data2):
+    """Two-sample unbiased Dcorr for 1-D samples without distance matrices
+
+    Uses the U-centered inner product of Szekely & Rizzo,
+    sum(A * B) + A.. B.. / ((n - 1)(n - 2)) - 2 / (n - 2) sum(a_i. b_i.),
+    so only row sums of the distance matrices are needed. This is the statistic
+    hyppo's `auto=True` computes, so its chi-squared p-value applies.
+    """
+    z = np.concatenate((data1, data2)).astype(float)
+    n = len(z)
+    n1 = len(data1)
+    n2 = len(data2)
+    if n < 4:
+        return 0.0, 1.0
+
+    def u_inner(sum_ab, total_a, total_b, rows_ab):
+        return (
+            sum_ab
+            + total_a * total_b / ((n - 1) * (n - 2))
+            - 2 * rows_ab / (n - 2)
+        )
+
+    # distances between points
+    r = _dist_row_sums(z)
+    total = r.sum()
+    sum_a2 = 2 * n * (z ** 2).sum() - 2 * z.sum() ** 2
+    cov_aa = u_inner(sum_a2, total, total, r @ r)
+
+    # distances between labels: 1 if in different samples
+    rb = np.repeat([n2, n1], [n1, n2]).astype(float)
+    total_b = 2.0 * n1 * n2
+    cov_bb = u_inner(total_b, total_b, total_b, rb @ rb)
+
+    # cross-sample distance sum from the within-sample sums
+    cross = total - _dist_row_sums(z[:n1]).sum() - _dist_row_sums(z[n1:]).sum()
+    cov_ab = u_inner(cross, total, total_b, r @ rb)
+
+    if cov_aa <= 0 or cov_bb <= 0:
+        return 0.0, 1.0
+    stat = cov_ab / np.sqrt(cov_aa * cov_bb)
+    pval = chi2.sf(stat * n + 1, 1)
     return stat, pval
 
 
-def spatial_dcorr(data1, data2, method="full", max_samples=1000, n_subsamples=5):
+def spatial_dcorr(
+    data1,
+    data2,
+    method="full",
+    max_samples=1000,
+    n_subsamples=5,
+    seed=None,
+    n_jobs=-1,
+    dist1=None,
+    dist2=None,
+    max_full_samples=None,
+):
     if (len(data1) == 0) or (len(data2) == 0):
         return np.nan, np.nan
 
+    # full distance matrices get too big, so fall back to subsampling, which
+    # keeps the same joint statistic
+    if (
+        method == "full"
+        and max_full_samples is not None
+        and max(len(data1), len(data2)) > max_full_samples
+    ):
+        method = "subsample"
+
     if method == "subsample":
         if max(len(data1), len(data2)) < max_samples:
             method = "full"
         else:
-            stats = np.empty(n_subsamples)
-            p_vals = np.empty(n_subsamples)
+            rng = np.random.default_rng(seed)
+            # draw every subsample at once: row i holds the indices for subsample i
+            all_inds = []
+            for data in [data1, data2]:
+                n_keep = min(len(data), max_samples)
+                inds = rng.random((n_subsamples, len(data))).argsort(axis=1)
+                all_inds.append(inds[:, :n_keep])
             all_shuffles = []
             for i in range(n_subsamples):
                 subsampled_data = []
-                for data in [data1, data2]:
-                    n_subsamples = min(len(data), max_samples)
-                    inds = np.random.choice(
-                        n_subsamples, size=n_subsamples, replace=False
-                    )
+                subsampled_dists = []
+                for data, dist, inds in zip([data1, data2], [dist1, dist2], all_inds):
+                    inds = inds[i]
                     subsampled_data.append(data[inds])
-                all_shuffles.append(subsampled_data)
-            outs = Parallel(n_jobs=-1)(delayed(run_dcorr)(*s) for s in all_shuffles)
+                    if dist is not None:
+                        dist = dist[np.ix_(inds, inds)]
+                    subsampled_dists.append(dist)
+                all_shuffles.append((subsampled_data, subsampled_dists))
+            outs = Parallel(n_jobs=n_jobs)(
+                delayed(run_dcorr)(*data, *dists) for data, dists in all_shuffles
+            )
             outs = list(zip(*outs))
             stats = outs[0]
             p_vals = outs[1]
@@ -142,14 +269,21 @@ def spatial_dcorr(data1, data2, method="full", max_samples=1000, n_subsamples=5)
         max_dim_stat = -np.inf
         best_p_val = np.nan
         for dim in range(data1.shape[1]):
-            dim_stat, dim_p_val = run_dcorr(data1[:, dim], data2[:, dim])
+            dim_stat, dim_p_val = run_dcorr(data1[:, [dim]], data2[:, [dim]])
             if dim_stat > max_dim_stat:
                 max_dim_stat = dim_stat
                 best_p_val = dim_p_val
         stat = max_dim_stat
         p_val = best_p_val
+    if method == "fast":
+        dim_outs = [
+            fast_dcorr_1d(data1[:, dim], data2[:, dim]) for dim in range(data1.shape[1])
+        ]
+        stat, p_val = max(dim_outs, key=lambda out: out[0])
+        # Bonferroni for taking the max over axes
+        p_val = min(p_val * len(dim_outs), 1.0)
     if method == "full":
-        stat, p_val = run_dcorr(data1, data2)
+        stat, p_val = run_dcorr(data1, data2, dist1=dist1, dist2=dist2)
     return stat, p_val
 
 
@@ -157,41 +291,78 @@ def spatial_dcorr(data1, data2, method="full", max_samples=1000, n_subsamples=5)
 # ##
 
 class_labels = meta[class_key].unique()
-p_vals = np.zeros((len(class_labels), len(class_labels)))
+n_classes = len(class_labels)
+p_vals = np.zeros((n_classes, n_classes))
 stats = np.zeros_like(p_vals)
 cluster_meta = pd.DataFrame(index=class_labels)
 
-total = comb(len(class_labels), k=2, exact=True)
-count = 0
+# filter the connectors for each class once, rather than once per pair
+comp_connectors, connector_groups = group_connectors(
+    connectors, direction, compartment
+)
+meta_labels = meta[class_key].values
+ids_by_class = {
+    label: meta.index.values[meta_labels == label] for label in class_labels
+}
+class_points = {}
+for label in class_labels:
+    label_ids = ids_by_class[label]
+    label_connectors = filter_connectors(comp_connectors, connector_groups, label_ids)
+    cluster_meta.loc[label, "n_samples"] = len(label_connectors)
+    class_points[label] = label_connectors[["x", "y", "z"]].to_numpy(
+        dtype=np.float32
+    )
+
+# within-class distances are shared by every pair a class is in, so compute them
+# once; only for classes small enough that the matrix is cheap to hold and ship
+class_dists = {}
+for label, points in class_points.items():
+    if len(points) <= max_samples:
+        class_dists[label] = euclidean(points).astype(np.float32)
+
+pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+
+# spatially disjoint classes are clearly different, so skip the test for them; they
+# get no statistic and are tracked in `disjoint_mask` instead
+class_bboxes = {}
+for label, points in class_points.items():
+    if len(points) > 0:
+        class_bboxes[label] = (points.min(axis=0), points.max(axis=0))
+disjoint_pairs = set()
+for i, j in pairs:
+    bbox1 = class_bboxes.get(class_labels[i])
+    bbox2 = class_bboxes.get(class_labels[j])
+    if bbox1 is not None and bbox2 is not None:
+        if bbox_gap(bbox1, bbox2) > max_bbox_gap:
+            disjoint_pairs.add((i, j))
+disjoint_mask = np.zeros((n_classes, n_classes), dtype=bool)
+for i, j in disjoint_pairs:
+    disjoint_mask[i, j] = True
+    stats[i, j] = np.nan
+    p_vals[i, j] = np.nan
+pairs = [pair for pair in pairs if pair not in disjoint_pairs]
+# one seed per pair so results don't depend on how pairs land on workers
+seeds = np.random.randint(np.iinfo(np.int32).max, size=len(pairs))
 currtime = time.time()
 
-for i, label1 in enumerate(class_labels):
-    label1_meta = meta[meta[class_key] == label1]
-    label1_ids = label1_meta.index.values
-    label1_connectors = filter_connectors(
-        connectors, label1_ids, direction, compartment
+outs = Parallel(n_jobs=-1, verbose=10)(
+    delayed(spatial_dcorr)(
+        class_points[class_labels[i]],
+        class_points[class_labels[j]],
+        method=method,
+        max_samples=max_samples,
+        n_subsamples=n_subsamples,
+        seed=seed,
+        n_jobs=1,
+        dist1=class_dists.get(class_labels[i]),
+        dist2=class_dists.get(class_labels[j]),
+        max_full_samples=max_full_samples,
     )
-    cluster_meta.loc[label1, "n_samples"] = len(label1_connectors)
-    for j, label2 in enumerate(class_labels):
-        if i < j:
-            print(f"Progress: {count / total:.2f}")
-            label2_meta = meta[meta[class_key] == label2]
-            label2_ids = label2_meta.index.values
-            label2_connectors = filter_connectors(
-                connectors, label2_ids, direction, compartment
-            )
-            data1 = label1_connectors[["x", "y", "z"]].values
-            data2 = label2_connectors[["x", "y", "z"]].values
-            stat, p_val = spatial_dcorr(
-                data1,
-                data2,
-                method=method,
-                max_samples=max_samples,
-                n_subsamples=n_subsamples,
-            )
-            stats[i, j] = stat
-            p_vals[i, j] = p_val
-            count += 1
+    for (i, j), seed in zip(pairs, seeds)
+)
+for (i, j), (stat, p_val) in zip(pairs, outs):
+    stats[i, j] = stat
+    p_vals[i, j] = p_val
 
 print(f"\n{time.time() - currtime} elapsed\n")
 
@@ -212,9 +383,23 @@ stats_df = pd.DataFrame(
 )
 stashcsv(stats_df, "test-stats" + basename)
 
+disjoint_df = pd.DataFrame(
+    data=disjoint_mask, index=cluster_meta.index, columns=cluster_meta.index
+)
+stashcsv(disjoint_df, "disjoint" + basename)
+
+
+def plot_disjoint(ax):
+    """Grey out the untested, spatially disjoint pairs"""
+    disjoint_cells = np.where(disjoint_mask, 1.0, np.nan)
+    ax.pcolormesh(
+        disjoint_cells, cmap=mpl.colors.ListedColormap(["lightgrey"]), zorder=0.5
+    )
+
+
 plot_p_vals = -np.log10(p_vals)
 plt.figure()
-adjplot(
+ax, *_ = adjplot(
     plot_p_vals,
     meta=cluster_meta,
     vmax=np.nanmax(plot_p_vals[~np.isinf(plot_p_vals)]),
@@ -222,10 +407,11 @@ adjplot(
     cbar=True,
     cmap="Reds",
 )
+plot_disjoint(ax)
 stashfig("p-val-plot" + basename)
 
 plt.figure(figsize=(10, 10))
-sns.heatmap(
+ax = sns.heatmap(
     stats,
     cmap="Reds",
     cbar_kws=dict(shrink=0.7),
@@ -233,4 +419,5 @@ sns.heatmap(
     xticklabels=False,
     yticklabels=False,
 )
+plot_disjoint(ax)
 stashfig("stats-plot" + basename)
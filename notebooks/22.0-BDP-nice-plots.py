@@ -557,10 +557,13 @@ def proportional_search(adj, class_ind_map, or_classes, ids, thresh):
 
 def update_class_map(cell_ids, classes):
     unique_classes, inverse_classes = np.unique(classes, return_inverse=True)
+    # bucket indices by class with one sort rather than a scan per class
+    order = np.argsort(inverse_classes, kind="stable")
+    bounds = np.r_[0, np.bincount(inverse_classes).cumsum()]
     class_ind_map = {}
     class_ids_map = {}
     for i, class_name in enumerate(unique_classes):
-        inds = np.where(inverse_classes == i)[0]
+        inds = order[bounds[i] : bounds[i + 1]]
         ids = cell_ids[inds]
         class_ind_map[class_name] = inds
         class_ids_map[class_name] = ids
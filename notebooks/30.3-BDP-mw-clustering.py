@@ -17,15 +17,19 @@ import seaborn as sns
 from joblib import Parallel, delayed
 from joblib.parallel import Parallel, delayed
 from matplotlib.colors import LogNorm
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import svds
 from sklearn.cluster import KMeans
 from sklearn.metrics import adjusted_rand_score
+from sklearn.mixture import GaussianMixture
 from spherecluster import SphericalKMeans
+from threadpoolctl import threadpool_limits
 
-from graspy.cluster import GaussianCluster
 from graspy.embed import AdjacencySpectralEmbed, OmnibusEmbed
 from graspy.models import SBMEstimator
 from graspy.plot import heatmap, pairplot
-from graspy.utils import binarize, cartprod, get_lcc, pass_to_ranks
+from graspy.utils import binarize, is_almost_symmetric, pass_to_ranks
 from src.data import load_everything
 from src.utils import export_skeleton_json, savefig
 from src.visualization import sankey
@@ -54,6 +58,7 @@ MIN_CLUSTERS = 2
 MAX_CLUSTERS = 100
 N_INIT = 200
 PTR = True
+PLOT_KS = [2, 5, 10, 20, 50, 100]
 
 np.random.seed(23409857)
 
@@ -85,8 +90,8 @@ def annotate_arrow(ax, coords=(0.061, 0.93)):
     )
 
 
-def ase(adj, n_components):
-    if PTR:
+def ase(adj, n_components, ptr=PTR):
+    if ptr:
         adj = pass_to_ranks(adj)
     ase = AdjacencySpectralEmbed(n_components=n_components)
     latent = ase.fit_transform(adj)
@@ -162,30 +167,34 @@ def to_laplace(graph, form="DAD", regularizer=None):
     in_root[np.isinf(in_root)] = 0
     out_root[np.isinf(out_root)] = 0
 
-    in_root = np.diag(in_root)  # just change to sparse diag for sparse support
-    out_root = np.diag(out_root)
-
+    # scaling rows and columns directly, rather than multiplying by diagonal matrices
     if form == "I-DAD":
-        L = np.diag(in_degree) - A
-        L = in_root @ L @ in_root
+        L = -(in_root[:, np.newaxis] * A * in_root[np.newaxis, :])
+        L[np.diag_indices_from(L)] += in_root * in_degree * in_root
     elif form == "DAD" or form == "R-DAD":
-        L = out_root @ A @ in_root
+        L = out_root[:, np.newaxis] * A * in_root[np.newaxis, :]
     # return symmetrize(L, method="avg")  # sometimes machine prec. makes this necessary
     return L
 
 
-def lse(adj, n_components, regularizer=None):
-    if PTR:
+def lse(adj, n_components, regularizer=None, ptr=PTR):
+    if ptr:
         adj = pass_to_ranks(adj)
     lap = to_laplace(adj, form="R-DAD")
-    ase = AdjacencySpectralEmbed(n_components=n_components)
-    latent = ase.fit_transform(lap)
-    latent = np.concatenate(latent, axis=-1)
+    # only the top singular vectors are needed, so skip ASE's full decomposition
+    U, D, Vt = svds(lap, k=n_components)
+    sort_inds = np.argsort(D)[::-1]
+    root_D = np.sqrt(D[sort_inds])
+    out_latent = U[:, sort_inds] * root_D
+    if is_almost_symmetric(lap):
+        return out_latent
+    in_latent = Vt[sort_inds].T * root_D
+    latent = np.concatenate((out_latent, in_latent), axis=-1)
     return latent
 
 
-def omni(adjs, n_components):
-    if PTR:
+def omni(adjs, n_components, ptr=PTR):
+    if ptr:
         adjs = [pass_to_ranks(a) for a in adjs]
     omni = OmnibusEmbed(n_components=n_components // len(adjs))
     latent = omni.fit_transform(adjs)
@@ -194,8 +203,8 @@ def omni(adjs, n_components):
     return latent
 
 
-def ase_concatenate(adjs, n_components):
-    if PTR:
+def ase_concatenate(adjs, n_components, ptr=PTR):
+    if ptr:
         adjs = [pass_to_ranks(a) for a in adjs]
     ase = AdjacencySpectralEmbed(n_components=n_components // len(adjs))
     graph_latents = []
@@ -208,29 +217,33 @@ def ase_concatenate(adjs, n_components):
 
 
 def degree(adjs, *args):
-    deg_mat = np.zeros((n_verts, 2 * N_GRAPH_TYPES))
-    for i, g in enumerate(adjs):
-        deg_mat[:, i] = g.sum(axis=0)
-        deg_mat[:, i + N_GRAPH_TYPES] = g.sum(axis=1)
+    graphs = np.stack(adjs, axis=0)  # n_graphs x n_verts x n_verts
+    in_degree = graphs.sum(axis=1).T
+    out_degree = graphs.sum(axis=2).T
+    deg_mat = np.concatenate((in_degree, out_degree), axis=1)
     return deg_mat
 
 
-def get_sbm_prob(adj, labels):
+def get_sbm_prob(adj, block_inv, block_labels):
+    # block_inv is already in size order, so block_p_ needs no reordering
     sbm = SBMEstimator(directed=True, loops=True)
-    sbm.fit(binarize(adj), y=labels)
+    sbm.fit(binarize(adj), y=block_inv)
     data = sbm.block_p_
-    uni_labels, counts = np.unique(labels, return_counts=True)
-    sort_inds = np.argsort(counts)[::-1]
-    uni_labels = uni_labels[sort_inds]
-    data = data[np.ix_(sort_inds, sort_inds)]
 
-    prob_df = pd.DataFrame(columns=uni_labels, index=uni_labels, data=data)
+    prob_df = pd.DataFrame(columns=block_labels, index=block_labels, data=data)
 
     return prob_df
 
 
 def probplot(
-    prob_df, ax=None, title=None, log_scale=False, cmap="Purples", vmin=None, vmax=None
+    prob_df,
+    ax=None,
+    title=None,
+    log_scale=False,
+    cmap="Purples",
+    vmin=None,
+    vmax=None,
+    max_annot_blocks=20,
 ):
     cbar_kws = {"fraction": 0.08, "shrink": 0.8, "pad": 0.03}
 
@@ -257,6 +270,17 @@ def probplot(
 
     sns.set_context("talk", font_scale=1)
 
+    # annotating every cell is slow and unreadable for many blocks
+    if len(prob_df) > max_annot_blocks:
+        if log_scale:
+            im = ax.imshow(data, cmap=cmap, norm=log_norm)
+        else:
+            im = ax.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax)
+        plt.colorbar(im, ax=ax, **cbar_kws)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        return ax
+
     heatmap_kws = dict(
         cbar_kws=cbar_kws,
         annot=True,
@@ -277,48 +301,35 @@ def probplot(
     return ax
 
 
-def _get_block_indices(y):
+def _get_sorted_block_inv(y):
     """
     y is a length n_verts vector of labels
-    returns a length n_verts vector in the same order as the input
-    indicates which block each node is
+    returns the unique labels sorted by decreasing block size, and a length n_verts
+    vector in the same order as the input indicating each node's block in that order
     """
     block_labels, block_inv, block_sizes = np.unique(
         y, return_inverse=True, return_counts=True
     )
-
-    n_blocks = len(block_labels)
-    block_inds = range(n_blocks)
-
-    block_vert_inds = []
-    for i in block_inds:
-        # get the inds from the original graph
-        inds = np.where(block_inv == i)[0]
-        block_vert_inds.append(inds)
-    return block_vert_inds, block_inds, block_inv
+    sort_inds = np.argsort(block_sizes)[::-1]
+    block_ranks = np.argsort(sort_inds)
+    return block_labels[sort_inds], block_ranks[block_inv]
 
 
-def _calculate_block_edgesum(graph, block_inds, block_vert_inds):
+def _calculate_block_edgesum(graph, block_inv, n_blocks):
     """
     graph : input n x n graph 
-    block_inds : list of length n_communities
-    block_vert_inds : list of list, for each block index, gives every node in that block
-    return_counts : whether to calculate counts rather than proportions
+    block_inv : length n_verts vector giving the block index of each node
+    n_blocks : number of blocks
     """
-
-    n_blocks = len(block_inds)
-    block_pairs = cartprod(block_inds, block_inds)
-    block_p = np.zeros((n_blocks, n_blocks))
-
-    for p in block_pairs:
-        from_block = p[0]
-        to_block = p[1]
-        from_inds = block_vert_inds[from_block]
-        to_inds = block_vert_inds[to_block]
-        block = graph[from_inds, :][:, to_inds]
-        p = np.sum(block)
-        p = p / block.size
-        block_p[from_block, to_block] = p
+    n_verts = len(block_inv)
+    # one-hot block membership, so all block sums come from two matrix products
+    membership = csr_matrix(
+        (np.ones(n_verts), (np.arange(n_verts), block_inv)), shape=(n_verts, n_blocks)
+    )
+    from_sums = membership.T @ graph  # n_blocks x n_verts
+    block_sums = (membership.T @ from_sums.T).T
+    block_sizes = np.bincount(block_inv, minlength=n_blocks)
+    block_p = block_sums / np.outer(block_sizes, block_sizes)
     return block_p
 
 
@@ -373,11 +384,11 @@ def clustergram(
     probplot(block_sum_df, ax=ax[3], title="Average synapses")
 
 
-def get_block_edgesums(adj, pred_labels, sort_blocks):
-    block_vert_inds, block_inds, block_inv = _get_block_indices(pred_labels)
-    block_sums = _calculate_block_edgesum(adj, block_inds, block_vert_inds)
-    block_sums = block_sums[np.ix_(sort_blocks, sort_blocks)]
-    block_sum_df = pd.DataFrame(data=block_sums, columns=sort_blocks, index=sort_blocks)
+def get_block_edgesums(adj, block_inv, block_labels):
+    block_sums = _calculate_block_edgesum(adj, block_inv, len(block_labels))
+    block_sum_df = pd.DataFrame(
+        data=block_sums, columns=block_labels, index=block_labels
+    )
     return block_sum_df
 
 
@@ -414,32 +425,43 @@ adj, class_labels, side_labels, skeleton_labels = load_everything(
     "Gad", version=BRAIN_VERSION, return_class=True, return_side=True, return_ids=True
 )
 
+# keep the graph sparse while preprocessing
+adj = csr_matrix(adj)
+adj.eliminate_zeros()
+
 # select the right hemisphere
 right_inds = np.where(side_labels == " mw right")[0]
-adj = adj[np.ix_(right_inds, right_inds)]
+adj = adj[right_inds][:, right_inds]
 class_labels = class_labels[right_inds]
 skeleton_labels = skeleton_labels[right_inds]
 
 # sort by number of synapses
-degrees = adj.sum(axis=0) + adj.sum(axis=1)
+degrees = np.asarray(adj.sum(axis=0)).ravel() + np.asarray(adj.sum(axis=1)).ravel()
 sort_inds = np.argsort(degrees)[::-1]
 class_labels = class_labels[sort_inds]
-adj = adj[np.ix_(sort_inds, sort_inds)]
+adj = adj[sort_inds][:, sort_inds]
 skeleton_labels = skeleton_labels[sort_inds]
 
 # remove disconnected nodes
-adj, lcc_inds = get_lcc(adj, return_inds=True)
+_, components = connected_components(adj, directed=True, connection="weak")
+lcc_inds = np.flatnonzero(components == np.bincount(components).argmax())
+adj = adj[lcc_inds][:, lcc_inds]
 class_labels = class_labels[lcc_inds]
 skeleton_labels = skeleton_labels[lcc_inds]
 
 # remove pendants?
-degrees = np.count_nonzero(adj, axis=0) + np.count_nonzero(adj, axis=1)
+in_degrees = np.bincount(adj.indices, minlength=adj.shape[1])
+out_degrees = np.diff(adj.indptr)
+degrees = in_degrees + out_degrees
 not_pendant_mask = degrees != 1
 not_pendant_inds = np.array(range(len(degrees)))[not_pendant_mask]
 class_labels = class_labels[not_pendant_inds]
-adj = adj[np.ix_(not_pendant_inds, not_pendant_inds)]
+adj = adj[not_pendant_inds][:, not_pendant_inds]
 skeleton_labels = skeleton_labels[not_pendant_inds]
 
+# embedding and plotting below need a dense matrix
+adj = adj.toarray()
+
 # plot degree sequence
 d_sort = np.argsort(degrees)[::-1]
 degrees = degrees[d_sort]
@@ -499,7 +521,13 @@ out_dicts = []
 embed = "LSE"
 cluster = "GMM"
 
-lse_latent = lse(adj, 4, regularizer=None)
+# rank transform once here, so the embedding functions needn't redo it
+if PTR:
+    ptr_adj = pass_to_ranks(adj)
+else:
+    ptr_adj = adj
+
+lse_latent = lse(ptr_adj, 4, regularizer=None, ptr=False)
 
 latent = lse_latent
 pairplot(latent, labels=simple_class_labels, title=embed)
@@ -508,6 +536,29 @@ k_list = list(range(MIN_CLUSTERS, MAX_CLUSTERS + 1))
 n_runs = len(k_list)
 
 
+def _fit_gmm(latent, k, covariance_type, seed):
+    # restarts already run in parallel, so keep BLAS from oversubscribing cores
+    with threadpool_limits(limits=1):
+        gmm = GaussianMixture(
+            n_components=k, covariance_type=covariance_type, random_state=seed
+        )
+        gmm.fit(latent)
+    return gmm
+
+
+def fit_best_gmm(latent, k, seed):
+    """Single restart per job over each covariance type, keeping the lowest BIC"""
+    seeds = np.random.RandomState(seed).randint(1e8, size=gmm_params["n_init"])
+    if gmm_params["covariance_type"] == "all":
+        covariance_types = ["spherical", "diag", "tied", "full"]
+    else:
+        covariance_types = [gmm_params["covariance_type"]]
+    gmms = Parallel(n_jobs=N_JOBS)(
+        delayed(_fit_gmm)(latent, k, cov, s) for cov in covariance_types for s in seeds
+    )
+    return min(gmms, key=lambda gmm: gmm.bic(latent))
+
+
 def cluster_func(k, seed):
     np.random.seed(seed)
     run_name = f"k = {k}, {cluster}, {embed}, right hemisphere (A to D), PTR, raw"
@@ -515,8 +566,7 @@ def cluster_func(k, seed):
     print()
 
     # Cluster
-    gmm = GaussianCluster(min_components=k, max_components=k, **gmm_params)
-    gmm.fit(latent)
+    gmm = fit_best_gmm(latent, k, seed)
     pred_labels = gmm.predict(latent)
 
     # ARI
@@ -525,7 +575,7 @@ def cluster_func(k, seed):
         "Cluster": cluster,
         "Embed": embed,
         "Method": f"{cluster} o {embed}",
-        "Score": gmm.model_.score(latent),
+        "Score": gmm.score(latent),
     }
     mb_ari = sub_ari(known_inds, mb_labels, pred_labels)
     mb_ari_dict = base_dict.copy()
@@ -547,28 +597,11 @@ def cluster_func(k, seed):
 
     save_name = f"k{k}-{cluster}-{embed}-right-ad-PTR-raw"
 
-    # Plot embedding
-    pairplot(latent, labels=pred_labels, title=run_name)
-    # stashfig("latent-" + save_name)
-
-    # Plot everything else
-    prob_df = get_sbm_prob(adj, pred_labels)
-    block_sum_df = get_block_edgesums(adj, pred_labels, prob_df.columns.values)
-
-    clustergram(adj, latent, prob_df, block_sum_df, simple_class_labels, pred_labels)
-    plt.suptitle(run_name, fontsize=40)
-    stashfig("clustergram-" + save_name)
-
     # output skeletons
     _, colormap, pal = stashskel(
         save_name, skeleton_labels, pred_labels, palette="viridis", multiout=True
     )
 
-    sns.set_context("talk")
-    palplot(k, cmap="viridis")
-
-    stashfig("palplot-" + save_name)
-
     # save dict colormapping
     filename = (
         Path("./maggot_models/notebooks/outs")
@@ -582,8 +615,31 @@ def cluster_func(k, seed):
         save_name, skeleton_labels, pred_labels, palette="viridis", multiout=False
     )
 
+    # rendering dominates the time per k, so only plot a few representative ones
+    if k not in PLOT_KS:
+        return
+
+    # Plot embedding
+    pairplot(latent, labels=pred_labels, title=run_name)
+    # stashfig("latent-" + save_name)
+
+    # Plot everything else
+    block_labels, block_inv = _get_sorted_block_inv(pred_labels)
+    prob_df = get_sbm_prob(adj, block_inv, block_labels)
+    block_sum_df = get_block_edgesums(adj, block_inv, block_labels)
+
+    clustergram(adj, latent, prob_df, block_sum_df, simple_class_labels, pred_labels)
+    plt.suptitle(run_name, fontsize=40)
+    stashfig("clustergram-" + save_name)
+
+    sns.set_context("talk")
+    palplot(k, cmap="viridis")
+
+    stashfig("palplot-" + save_name)
+    plt.close("all")
+
 
 seeds = np.random.randint(1e8, size=n_runs)
-Parallel(n_jobs=N_JOBS, verbose=10)(
-    delayed(cluster_func)(k, seed) for k, seed in zip(k_list, seeds)
-)
+# the GMM restarts within each k are parallelized, so loop over k serially
+for k, seed in zip(k_list, seeds):
+    cluster_func(k, seed)
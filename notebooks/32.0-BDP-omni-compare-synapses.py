@@ -32,11 +32,13 @@ from graspy.cluster import GaussianCluster
 from graspy.embed import AdjacencySpectralEmbed, OmnibusEmbed
 from graspy.models import SBMEstimator
 from graspy.plot import heatmap, pairplot
-from graspy.utils import binarize, cartprod, pass_to_ranks
+from graspy.utils import binarize, pass_to_ranks
 from joblib.parallel import Parallel, delayed
 from matplotlib.colors import LogNorm
+from scipy.sparse import csr_matrix, issparse
+from scipy.stats import rankdata
 from sklearn.cluster import KMeans
-from sklearn.metrics import adjusted_rand_score
+from sklearn.metrics.cluster import contingency_matrix
 from spherecluster import SphericalKMeans
 
 from src.data import load_everything
@@ -86,8 +88,17 @@ def annotate_arrow(ax, coords=(0.061, 0.93)):
     )
 
 
-def ase(adj, n_components):
-    if PTR:
+def sparse_pass_to_ranks(adj):
+    """Same as graspy's default "simple-nonzero" pass to ranks, but only sorts the
+    stored nonzeros of a sparse matrix"""
+    adj = csr_matrix(adj, copy=True)
+    adj.eliminate_zeros()
+    adj.data = rankdata(adj.data) / (adj.nnz + 1)
+    return adj
+
+
+def ase(adj, n_components, ptr=PTR):
+    if ptr:
         adj = pass_to_ranks(adj)
     ase = AdjacencySpectralEmbed(n_components=n_components)
     latent = ase.fit_transform(adj)
@@ -158,25 +169,28 @@ def to_laplace(graph, form="DAD", regularizer=None):
 
     with np.errstate(divide="ignore"):
         in_root = 1 / np.sqrt(in_degree)  # this is 10x faster than ** -0.5
-        out_root = 1 / np.sqrt(out_degree)
-
     in_root[np.isinf(in_root)] = 0
-    out_root[np.isinf(out_root)] = 0
 
-    in_root = np.diag(in_root)  # just change to sparse diag for sparse support
-    out_root = np.diag(out_root)
+    # undirected (or otherwise degree-balanced) graphs only need one scaling
+    if np.array_equal(in_degree, out_degree):
+        out_root = in_root
+    else:
+        with np.errstate(divide="ignore"):
+            out_root = 1 / np.sqrt(out_degree)
+        out_root[np.isinf(out_root)] = 0
 
+    # scaling rows and columns directly, rather than multiplying by diagonal matrices
     if form == "I-DAD":
-        L = np.diag(in_degree) - A
-        L = in_root @ L @ in_root
+        L = -(in_root[:, np.newaxis] * A * in_root[np.newaxis, :])
+        L[np.diag_indices_from(L)] += in_root * in_degree * in_root
     elif form == "DAD" or form == "R-DAD":
-        L = out_root @ A @ in_root
+        L = out_root[:, np.newaxis] * A * in_root[np.newaxis, :]
     # return symmetrize(L, method="avg")  # sometimes machine prec. makes this necessary
     return L
 
 
-def lse(adj, n_components, regularizer=None):
-    if PTR:
+def lse(adj, n_components, regularizer=None, ptr=PTR):
+    if ptr:
         adj = pass_to_ranks(adj)
     lap = to_laplace(adj, form="R-DAD")
     ase = AdjacencySpectralEmbed(n_components=n_components)
@@ -185,18 +199,32 @@ def lse(adj, n_components, regularizer=None):
     return latent
 
 
-def omni(adjs, n_components):
-    if PTR:
+def _concatenate_omni_latent(latent):
+    """Omnibus latent positions as one n_verts x (n_graphs * n_dims) array, laid out
+    as [out_1, in_1, out_2, in_2, ...], filled with a single copy"""
+    if not isinstance(latent, tuple):
+        latent = (latent,)
+    n_graphs, n_verts, n_dims = latent[0].shape
+    n_parts = len(latent)
+    out = np.empty((n_verts, n_graphs * n_parts * n_dims))
+    for i in range(n_graphs):
+        for j, part in enumerate(latent):
+            start = (i * n_parts + j) * n_dims
+            out[:, start : start + n_dims] = part[i]
+    return out
+
+
+def omni(adjs, n_components, ptr=PTR):
+    if ptr:
         adjs = [pass_to_ranks(a) for a in adjs]
     omni = OmnibusEmbed(n_components=n_components // len(adjs))
     latent = omni.fit_transform(adjs)
-    latent = np.concatenate(latent, axis=-1)  # first is for in/out
-    latent = np.concatenate(latent, axis=-1)  # second is for concat. each graph
+    latent = _concatenate_omni_latent(latent)
     return latent
 
 
-def ase_concatenate(adjs, n_components):
-    if PTR:
+def ase_concatenate(adjs, n_components, ptr=PTR):
+    if ptr:
         adjs = [pass_to_ranks(a) for a in adjs]
     ase = AdjacencySpectralEmbed(n_components=n_components // len(adjs))
     graph_latents = []
@@ -277,64 +305,33 @@ def probplot(
     return ax
 
 
-def _get_block_indices(y):
-    """
-    y is a length n_verts vector of labels
-    returns a length n_verts vector in the same order as the input
-    indicates which block each node is
-    """
-    block_labels, block_inv, block_sizes = np.unique(
-        y, return_inverse=True, return_counts=True
-    )
-
-    n_blocks = len(block_labels)
-    block_inds = range(n_blocks)
-
-    block_vert_inds = []
-    for i in block_inds:
-        # get the inds from the original graph
-        inds = np.where(block_inv == i)[0]
-        block_vert_inds.append(inds)
-    return block_vert_inds, block_inds, block_inv
-
-
-def _calculate_block_edgesum(graph, block_inds, block_vert_inds):
+def _calculate_block_edgesum(graph, block_inv, n_blocks):
     """
-    graph : input n x n graph 
-    block_inds : list of length n_communities
-    block_vert_inds : list of list, for each block index, gives every node in that block
-    return_counts : whether to calculate counts rather than proportions
+    graph : input n x n graph, dense or sparse
+    block_inv : length n_verts vector giving the block index of each node
+    n_blocks : number of blocks
     """
-
-    n_blocks = len(block_inds)
-    block_pairs = cartprod(block_inds, block_inds)
-    block_p = np.zeros((n_blocks, n_blocks))
-
-    for p in block_pairs:
-        from_block = p[0]
-        to_block = p[1]
-        from_inds = block_vert_inds[from_block]
-        to_inds = block_vert_inds[to_block]
-        block = graph[from_inds, :][:, to_inds]
-        p = np.sum(block)
-        p = p / block.size
-        block_p[from_block, to_block] = p
+    # only edges contribute, so sum edge weights by (from block, to block) pair
+    if issparse(graph):
+        graph = graph.tocoo()
+        rows, cols, weights = graph.row, graph.col, graph.data
+    else:
+        rows, cols = np.nonzero(graph)
+        weights = graph[rows, cols]
+    pair_inds = block_inv[rows] * n_blocks + block_inv[cols]
+    block_sums = np.bincount(pair_inds, weights=weights, minlength=n_blocks ** 2)
+    block_sums = block_sums.reshape(n_blocks, n_blocks)
+    block_sizes = np.bincount(block_inv, minlength=n_blocks)
+    block_p = block_sums / np.outer(block_sizes, block_sizes)
     return block_p
 
 
 def get_colors(true_labels, pred_labels):
-    color_dict = {}
     classes = np.unique(true_labels)
-    known_palette = sns.color_palette("tab10", n_colors=len(classes))
-    for i, true_label in enumerate(classes):
-        color = known_palette[i]
-        color_dict[true_label] = color
+    color_dict = dict(zip(classes, sns.color_palette("tab10", n_colors=len(classes))))
 
     classes = np.unique(pred_labels)
-    known_palette = sns.color_palette("gray", n_colors=len(classes))
-    for i, pred_label in enumerate(classes):
-        color = known_palette[i]
-        color_dict[pred_label] = color
+    color_dict.update(zip(classes, sns.color_palette("gray", n_colors=len(classes))))
     return color_dict
 
 
@@ -369,18 +366,35 @@ def clustergram(
 
 
 def get_block_edgesums(adj, pred_labels, sort_blocks):
-    block_vert_inds, block_inds, block_inv = _get_block_indices(pred_labels)
-    block_sums = _calculate_block_edgesum(adj, block_inds, block_vert_inds)
+    block_labels, block_inv = np.unique(pred_labels, return_inverse=True)
+    block_sums = _calculate_block_edgesum(adj, block_inv, len(block_labels))
     sort_blocks = prob_df.columns.values
     block_sums = block_sums[np.ix_(sort_blocks, sort_blocks)]
     block_sum_df = pd.DataFrame(data=block_sums, columns=sort_blocks, index=sort_blocks)
     return block_sum_df
 
 
+def _comb2(x):
+    return x * (x - 1) / 2
+
+
+def fast_ari(true_labels, pred_labels):
+    """Adjusted Rand index computed from a sparse contingency table"""
+    contingency = contingency_matrix(true_labels, pred_labels, sparse=True)
+    sum_comb = _comb2(contingency.data).sum()
+    sum_comb_true = _comb2(np.asarray(contingency.sum(axis=1)).ravel()).sum()
+    sum_comb_pred = _comb2(np.asarray(contingency.sum(axis=0)).ravel()).sum()
+    expected = sum_comb_true * sum_comb_pred / _comb2(len(true_labels))
+    max_index = (sum_comb_true + sum_comb_pred) / 2
+    if max_index == expected:
+        return 1.0
+    return (sum_comb - expected) / (max_index - expected)
+
+
 def sub_ari(known_inds, true_labels, pred_labels):
     true_known_labels = true_labels[known_inds]
     pred_known_labels = pred_labels[known_inds]
-    ari = adjusted_rand_score(true_known_labels, pred_known_labels)
+    ari = fast_ari(true_known_labels, pred_known_labels)
     return ari
 
 
@@ -396,15 +410,16 @@ adj, class_labels, side_labels = load_everything(
     "G", version=BRAIN_VERSION, return_class=True, return_side=True
 )
 
+# keep the graphs sparse until they are embedded
 color_adjs = []
 for t in GRAPH_TYPES:
-    adj = load_everything(t)
+    adj = csr_matrix(load_everything(t))
     color_adjs.append(adj)
 
-sum_adj = np.sum(color_adjs, axis=0)
+sum_adj = sum(color_adjs[1:], color_adjs[0])
 
 embed_adjs = [color_adjs[0], sum_adj]
-embed_adjs = [pass_to_ranks(g) for g in embed_adjs]
+embed_adjs = [sparse_pass_to_ranks(g).toarray() for g in embed_adjs]
 
 embed = OmnibusEmbed(n_components=4)
 latents = embed.fit_transform(embed_adjs)
@@ -419,15 +434,20 @@ pairplot(plot_latents, plot_class_labels, palette="tab20")
 
 #%%
 diffs = np.linalg.norm(latents[0] - latents[1], axis=1)
-plt.figure(figsize=(20, 10))
+fig, ax = plt.subplots(1, 1, figsize=(20, 10))
 sns.set_palette("tab20")
 sns.set_context("talk", font_scale=1.25)
-uni_classes = np.unique(class_labels)
-for i, name in enumerate(uni_classes):
-    inds = np.where(class_labels == name)[0]
-    class_diffs = diffs[inds]
-    sns.distplot(class_diffs, label=name, kde=False, norm_hist=True)
-plt.legend()
+# one call with shared bins rather than one histogram per class
+names, class_diffs = zip(*pd.Series(diffs).groupby(class_labels))
+ax.hist(
+    [group.values for group in class_diffs],
+    bins=np.histogram_bin_edges(diffs, bins="auto"),
+    density=True,
+    histtype="stepfilled",
+    alpha=0.4,
+    label=names,
+)
+ax.legend()
 
 
 # %%
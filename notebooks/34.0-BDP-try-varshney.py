@@ -4,8 +4,6 @@
 # %% [markdown]
 # ## Imports and functions
 
-from operator import itemgetter
-
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
@@ -14,12 +12,27 @@ import seaborn as sns
 from graspy.embed import LaplacianSpectralEmbed
 from graspy.plot import heatmap
 from graspy.simulations import sbm
-from graspy.utils import get_lcc
+from scipy.sparse import csr_matrix, diags, identity
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh, lobpcg, lsmr
+from sklearn.decomposition import TruncatedSVD
 
 from src.data import load_everything
 
 
-def signal_flow(A, n_components=5, return_evals=False):
+def _lobpcg_smallest(Q, k):
+    """Smallest eigenpairs of a normalized Laplacian, warm-started by a loose SVD"""
+    # 2I - Q is PSD, so its leading singular vectors span Q's smallest eigenvectors
+    Q_shift = 2 * identity(Q.shape[0]) - Q
+    tsvd = TruncatedSVD(n_components=k, algorithm="arpack", tol=1e-2)
+    X0 = tsvd.fit(Q_shift).components_.T
+    evals, evecs = lobpcg(Q, X0, largest=False, tol=1e-4, maxiter=200)
+    return evals, evecs
+
+
+def signal_flow(
+    A, n_components=5, return_evals=False, n_evals=10, lobpcg_min_verts=5000
+):
     """ Implementation of the signal flow metric from Varshney et al 2011
     
     Parameters
@@ -32,23 +45,33 @@ def signal_flow(A, n_components=5, return_evals=False):
     [type]
         [description]
     """
-    W = (A + A.T) / 2
-
-    D = np.diag(np.sum(W, axis=1))
-
-    L = D - W
-
-    b = np.sum(W * np.sign(A - A.T), axis=1)
-    L_pinv = np.linalg.pinv(L)
-    z = L_pinv @ b
-
-    D_root = np.diag(np.diag(D) ** (-1 / 2))
+    A = csr_matrix(A)
+    W = (A + A.T).multiply(0.5).tocsr()
+    d = np.asarray(W.sum(axis=1)).ravel()
+    L = diags(d) - W
+
+    # solve L z = b directly rather than forming the dense pseudoinverse
+    b = np.asarray(W.multiply((A - A.T).sign()).sum(axis=1)).ravel()
+    z = lsmr(L, b, atol=1e-6)[0]
+
+    with np.errstate(divide="ignore"):
+        d_root = d ** (-1 / 2)
+    d_root[np.isinf(d_root)] = 0
+    D_root = diags(d_root)
     Q = D_root @ L @ D_root
-    evals, evecs = np.linalg.eig(Q)
+
+    # Q is symmetric with spectrum in [0, 2], so the smallest eigenpairs of Q are
+    # the largest of 2I - Q, which Lanczos finds much faster than which="SM"
+    k = min(max(n_components + 1, n_evals), Q.shape[0] - 1)
+    if lobpcg_min_verts is not None and Q.shape[0] > lobpcg_min_verts:
+        evals, evecs = _lobpcg_smallest(Q, k)
+    else:
+        evals, evecs = eigsh(2 * identity(Q.shape[0]) - Q, k=k, which="LA", tol=1e-4)
+        evals = 2 - evals
     inds = np.argsort(evals)
     evals = evals[inds]
     evecs = evecs[:, inds]
-    evecs = np.diag(np.diag(D) ** (1 / 2)) @ evecs
+    evecs = evecs * np.sqrt(d)[:, np.newaxis]
     # return evals, evecs, z, D_root
     scatter_df = pd.DataFrame()
     for i in range(1, n_components + 1):
@@ -61,15 +84,42 @@ def signal_flow(A, n_components=5, return_evals=False):
 
 
 def get_feedforward_B(low_p, diag_p, feedforward_p, n_blocks=5):
-    B = np.zeros((n_blocks, n_blocks))
-    B += low_p
-    B -= np.diag(np.diag(B))
-    B -= np.diag(np.diag(B, k=1), k=1)
-    B += np.diag(diag_p * np.ones(n_blocks))
-    B += np.diag(feedforward_p * np.ones(n_blocks - 1), k=1)
+    B = np.full((n_blocks, n_blocks), low_p, dtype=float)
+    inds = np.arange(n_blocks)
+    B[inds, inds] = diag_p
+    B[inds[:-1], inds[1:]] = feedforward_p
     return B
 
 
+def plot_lap_components(
+    scatter_df, title, components=["Lap-2", "Lap-3", "Lap-4", "Lap-5"]
+):
+    plot_df = scatter_df.melt(
+        id_vars=["Signal flow", "Class", "Side"],
+        value_vars=components,
+        var_name="Component",
+        value_name="Value",
+    )
+    fg = sns.relplot(
+        x="Value",
+        y="Signal flow",
+        data=plot_df,
+        col="Component",
+        col_wrap=2,
+        hue="Class",
+        style="Side",
+        markers=[">", "<"],
+        palette=total_palette,
+        hue_order=hue_order,
+        s=90,
+        alpha=1,
+        height=7.5,
+        facet_kws=dict(sharex=False),
+    )
+    fg.fig.suptitle(title, y=1.02)
+    return fg
+
+
 plt.style.use("seaborn-white")
 sns.set_palette("deep")
 sns.set_context("talk", font_scale=1)
@@ -173,12 +223,16 @@ adj, class_labels, side_labels = load_everything(
     "Gad", GRAPH_VERSION, return_class=True, return_side=True
 )
 
-adj, inds = get_lcc(adj, return_inds=True)
+# keep the graph sparse; the largest weakly connected component is sliced out as CSR
+adj = csr_matrix(adj)
+_, component_labels = connected_components(adj, directed=True, connection="weak")
+inds = np.where(component_labels == np.bincount(component_labels).argmax())[0]
+adj = adj[inds][:, inds]
 class_labels = class_labels[inds]
 side_labels = side_labels[inds]
 
 name_map = {" mw right": "R", " mw left": "L"}
-side_labels = np.array(itemgetter(*side_labels)(name_map))
+side_labels = pd.Series(side_labels).map(name_map).values
 
 name_map = {
     "CN": "Unk",
@@ -197,7 +251,7 @@ name_map = {
     "Unidentified": "Unk",
     "Other": "Unk",
 }
-class_labels = np.array(itemgetter(*class_labels)(name_map))
+class_labels = pd.Series(class_labels).map(name_map).values
 
 # Construct a custom color palette
 total_palette = []
@@ -219,82 +273,20 @@ scatter_df["Class"] = class_labels
 scatter_df["Side"] = side_labels
 
 # Plot
-plt.figure(figsize=(10, 5))
-sns.scatterplot(range(1, 11), evals[:10])
-plt.title("Laplacian scree plot")
-plt.xlabel("Eigenvalue")
-plt.ylabel("Magnitude")
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D")
-sns.scatterplot(
-    x="Lap-2",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D")
-sns.scatterplot(
-    x="Lap-3",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
+fig, ax = plt.subplots(1, 1, figsize=(10, 5))
+ax.plot(np.arange(1, 11), evals[:10], "o")
+ax.set_title("Laplacian scree plot")
+ax.set_xlabel("Eigenvalue")
+ax.set_ylabel("Magnitude")
 
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D")
-sns.scatterplot(
-    x="Lap-4",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D")
-sns.scatterplot(
-    x="Lap-5",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
+plot_lap_components(scatter_df, r"A $\to$ D")
 plt.show()
 
 # %% [markdown]
 # # Now, do the same but for the sum of A $\rightarrow$ D and A $\rightarrow$ A
 
-adj_aa = load_everything("Gaa", version=GRAPH_VERSION)
-adj_aa = adj_aa[np.ix_(inds, inds)]
+adj_aa = csr_matrix(load_everything("Gaa", version=GRAPH_VERSION))
+adj_aa = adj_aa[inds][:, inds]
 adj = adj + adj_aa
 
 # Compute signal flow
@@ -303,75 +295,13 @@ scatter_df["Class"] = class_labels
 scatter_df["Side"] = side_labels
 
 # Plot
-plt.figure(figsize=(10, 5))
-sns.scatterplot(range(1, 11), evals[:10])
-plt.title("Laplacian scree plot")
-plt.xlabel("Eigenvalue")
-plt.ylabel("Magnitude")
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D + A $\to$ A")
-sns.scatterplot(
-    x="Lap-2",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D + A $\to$ A")
-sns.scatterplot(
-    x="Lap-3",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
-
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D + A $\to$ A")
-sns.scatterplot(
-    x="Lap-4",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
+fig, ax = plt.subplots(1, 1, figsize=(10, 5))
+ax.plot(np.arange(1, 11), evals[:10], "o")
+ax.set_title("Laplacian scree plot")
+ax.set_xlabel("Eigenvalue")
+ax.set_ylabel("Magnitude")
 
-plt.figure(figsize=(15, 15))
-plt.title(r"A $\to$ D + A $\to$ A")
-sns.scatterplot(
-    x="Lap-5",
-    y="Signal flow",
-    data=scatter_df,
-    hue="Class",
-    style="Side",
-    markers=[">", "<"],
-    palette=total_palette,
-    hue_order=hue_order,
-    s=90,
-    alpha=1,
-)
-plt.legend(bbox_to_anchor=(1.03, 1), loc=2, borderaxespad=0.0)
+plot_lap_components(scatter_df, r"A $\to$ D + A $\to$ A")
 plt.show()
 
 # #%%
@@ -171,62 +171,96 @@ pairplot(latent, labels=class_labels, title=embed)
 # #
 
 
+def _full_precisions_cholesky(gmm):
+    """Cholesky factors of the component precisions as (n_components, d, d) for any
+    covariance type"""
+    prec_chol = gmm.precisions_cholesky_
+    n_components, n_features = gmm.means_.shape
+    if gmm.covariance_type == "full":
+        return prec_chol
+    elif gmm.covariance_type == "tied":
+        return np.repeat(prec_chol[np.newaxis], n_components, axis=0)
+    elif gmm.covariance_type == "diag":
+        return np.stack([np.diag(p) for p in prec_chol])
+    else:  # spherical
+        return prec_chol[:, np.newaxis, np.newaxis] * np.eye(n_features)
+
+
 class PartitionCluster:
-    def __init__(self):
+    def __init__(self, depth=0, max_depth=None, K=5):
         self.min_split_samples = 5
+        self.depth = depth
+        self.max_depth = max_depth
+        self.K = K
 
     def fit(self, X, y=None):
         n_samples = X.shape[0]
+        self.pred_labels_ = np.zeros(n_samples)
+        self.left_ = None
+        self.right_ = None
+        self.model_ = None
+        self.max_depth_ = self.max_depth
+        if self.max_depth_ is None:
+            # enough binary splits to get down to ~K samples per leaf
+            self.max_depth_ = int(np.ceil(np.log2(max(n_samples / self.K, 2))))
+        if n_samples <= self.min_split_samples or self.depth >= self.max_depth_:
+            return self
 
-        if n_samples > self.min_split_samples:
-            cluster = GaussianCluster(min_components=1, max_components=2, n_init=20)
-            cluster.fit(X)
-            self.model_ = cluster
-        else:
-            self.pred_labels_ = np.zeros(X.shape[0])
-            self.left_ = None
-            self.right_ = None
-            self.model_ = None
+        # deeper splits see less data, and don't need as many restarts
+        n_init = max(2, 20 // 2 ** self.depth)
+        cluster = GaussianCluster(min_components=1, max_components=2, n_init=n_init)
+        cluster.fit(X)
+        if cluster.n_components_ == 1:
+            return self
+        pred_labels = cluster.predict(X)
+        indicator = pred_labels == 0
+        if indicator.all() or not indicator.any():
+            # one side of the "split" is empty
             return self
 
-        # recurse
-        if cluster.n_components_ != 1:
-            pred_labels = cluster.predict(X)
-            self.pred_labels_ = pred_labels
-            indicator = pred_labels == 0
-            self.X_left_ = X[indicator, :]
-            self.X_right_ = X[~indicator, :]
-            split_left = PartitionCluster()
-            self.left_ = split_left.fit(self.X_left_)
-
-            split_right = PartitionCluster()
-            self.right_ = split_right.fit(self.X_right_)
-        else:
-            self.pred_labels_ = np.zeros(X.shape[0])
-            self.left_ = None
-            self.right_ = None
-            self.model_ = None
+        # cache the fitted parameters so predict skips sklearn's overhead
+        self.model_ = cluster
+        gmm = cluster.model_
+        self._means = gmm.means_
+        self._prec_chol = _full_precisions_cholesky(gmm)
+        chol_diag = np.diagonal(self._prec_chol, axis1=1, axis2=2)
+        self._log_det = np.log(chol_diag).sum(axis=1)
+        self._log_w = np.log(gmm.weights_)
+        self.pred_labels_ = pred_labels
+        self.X_left_ = X[indicator, :]
+        self.X_right_ = X[~indicator, :]
+
+        # recurse, but sides too small to split are leaves without another fit
+        child_kws = dict(depth=self.depth + 1, max_depth=self.max_depth_, K=self.K)
+        self.left_ = PartitionCluster(**child_kws).fit(self.X_left_)
+        self.right_ = PartitionCluster(**child_kws).fit(self.X_right_)
         return self
 
-    def predict_sample(self, sample):
-        model = self.model_
-        if model is not None:
-            pred = model.predict([sample])[0]
-            if pred == 0:
-                next_pred = self.left_.predict_sample(sample)
-            if pred == 1:
-                next_pred = self.right_.predict_sample(sample)
-            total_pred = str(pred) + next_pred
-        else:
-            total_pred = ""
-        return total_pred
+    def _predict_batch(self, X):
+        """Most likely component for each sample, as in GaussianMixture.predict"""
+        log_prob = np.empty((X.shape[0], len(self._means)))
+        for k, (mean, prec_chol) in enumerate(zip(self._means, self._prec_chol)):
+            y = (X - mean) @ prec_chol
+            log_prob[:, k] = -0.5 * (y * y).sum(axis=1)
+        log_prob += self._log_det + self._log_w
+        return log_prob.argmax(axis=1)
 
     def predict(self, X):
-        predictions = []
-        for sample in X:
-            pred = self.predict_sample(sample)
-            predictions.append(pred)
-        return np.array(predictions)
+        # labels are at most max_depth_ characters, so size the string dtype once
+        labels = np.full(X.shape[0], "", dtype=f"<U{max(self.max_depth_, 1)}")
+        self._predict_into(X, labels, np.arange(X.shape[0]), "")
+        return labels
+
+    def _predict_into(self, X, labels, inds, prefix):
+        # predict all samples at this node at once, then recurse on each side
+        if self.model_ is None or len(inds) == 0:
+            labels[inds] = prefix
+            return
+        left_mask = self._predict_batch(X) == 0
+        self.left_._predict_into(X[left_mask], labels, inds[left_mask], prefix + "0")
+        self.right_._predict_into(
+            X[~left_mask], labels, inds[~left_mask], prefix + "1"
+        )
 
 
 pgmm = PartitionCluster()
@@ -241,27 +275,18 @@ stacked_barplot(pred_labels, class_labels)
 # %% [markdown]
 # #
 
-uni_labels = np.unique(pred_labels)
+uni_labels = np.unique(pred_labels).astype(str)
 # consider only the longest strings:
 
-label_lens = []
-for l in uni_labels:
-    str_len = len(l)
-    label_lens.append(str_len)
-label_lens = np.array(label_lens)
-max_len = max(label_lens)
+label_lens = np.char.str_len(uni_labels)
+max_len = label_lens.max()
 print(max_len)
 
-max_inds = np.where(label_lens == max_len)
-temp_labels = uni_labels[max_inds]
+temp_labels = uni_labels[label_lens == max_len]
 
 dist_mat = np.zeros((len(uni_labels), 4))
 
 # consider only temp_labels
 # find the ones that are pairs
-temp_labels = []
-for l in temp_labels:
-    temp_str = l[:-2]
-    print(temp_str)
-    temp_labels = []
+temp_strs = np.unique([l[:-2] for l in temp_labels])
     
\ No newline at end of file
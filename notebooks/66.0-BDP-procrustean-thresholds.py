@@ -3,14 +3,12 @@
 import os
 import pickle
 import warnings
-from operator import itemgetter
 from pathlib import Path
 from timeit import default_timer as timer
 
 import colorcet as cc
 import matplotlib.colors as mplc
 import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -25,19 +23,22 @@ from bokeh.sampledata.stocks import AAPL, GOOG, IBM, MSFT
 from joblib import Parallel, delayed
 from matplotlib.cm import ScalarMappable
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from numba import njit, prange
 from sklearn.metrics import adjusted_rand_score
 from sklearn.model_selection import ParameterGrid
-from sklearn.neighbors import NearestNeighbors
 from sklearn.utils.graph_shortest_path import graph_shortest_path
 from graspy.cluster import AutoGMMCluster, GaussianCluster
-from graspy.embed import AdjacencySpectralEmbed, LaplacianSpectralEmbed
-from graspy.utils import pass_to_ranks, get_lcc
+from graspy.embed import (
+    AdjacencySpectralEmbed,
+    LaplacianSpectralEmbed,
+    select_dimension,
+)
 from graspy.plot import degreeplot, edgeplot, gridplot, heatmap, pairplot
 from graspy.utils import symmetrize
 from src.cluster import DivisiveCluster
 from src.data import load_everything, load_metagraph, load_networkx
-from src.embed import ase, lse, preprocess_graph
-from src.graph import MetaGraph
+from src.embed import ase, preprocess_graph
+from src.embed.embed import to_laplace
 from src.hierarchy import signal_flow
 from src.io import savefig, saveobj, saveskels
 from src.utils import (
@@ -59,7 +60,11 @@ from src.visualization import (
 from bokeh.models import Select
 from bokeh.palettes import Spectral5
 from bokeh.plotting import curdoc, figure
-from scipy.linalg import orthogonal_procrustes
+from scipy.linalg import svd
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, diags
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import svds
+from scipy.stats import rankdata
 
 
 FNAME = os.path.basename(__file__)[:-3]
@@ -91,24 +96,179 @@ def stashskel(name, ids, labels, colors=None, palette=None, **kws):
     )
 
 
+def lse_svds(adj, n_components=None):
+    """R-DAD Laplacian spectral embedding from a truncated SVD. A sparse `adj` stays
+    sparse. If `n_components` is None, it is picked by `select_dimension` from the
+    same number of leading singular values that it would look at on a dense matrix"""
+    lap = to_laplace(adj, form="R-DAD")
+    k = n_components
+    if k is None:
+        k = int(np.ceil(np.log2(np.min(lap.shape))))
+    U, s, Vt = svds(lap, k=k)
+    sort_inds = np.argsort(s)[::-1]
+    s = s[sort_inds]
+    if n_components is None:
+        n_components = select_dimension(s, n_elbows=2)[0][-1]
+    sort_inds = sort_inds[:n_components]
+    s = s[:n_components]
+    U = U[:, sort_inds]
+    Vt = Vt[sort_inds]
+    root_s = np.sqrt(s)
+    latent = np.concatenate((U * root_s, Vt.T * root_s), axis=-1)
+    return latent
+
+
+def procrustes(left, right):
+    """Orthogonal matrix R minimizing ||left @ R - right||, as in
+    `orthogonal_procrustes`, from a float32 SVD"""
+    M = left.astype(np.float32, copy=False).T @ right.astype(np.float32, copy=False)
+    U, _, Vt = svd(M, lapack_driver="gesdd")
+    return U @ Vt
+
+
+def group_max(values, groups):
+    """Max of `values` over each group in `groups`, given back for every element"""
+    codes, _ = pd.factorize(groups)
+    order = np.argsort(codes, kind="stable")
+    starts = np.r_[0, np.flatnonzero(np.diff(codes[order])) + 1]
+    grp_max = np.maximum.reduceat(values[order], starts)
+    return grp_max[codes]
+
+
+@njit(parallel=True, cache=True)
+def _fill_neighbors_at_k(neigh_inds, left_inds, right_inds, k_max, is_neighbor_mat):
+    # a pair is within k neighbors from the first position it shows up at, and the
+    # first k_max + 1 neighbors include the point itself
+    for i in prange(len(left_inds)):
+        left_ind = left_inds[i]
+        right_ind = right_inds[i]
+        for j in range(k_max + 1):
+            if neigh_inds[left_ind, j] == right_ind:
+                is_neighbor_mat[left_ind, max(j - 1, 0) :] = True
+                break
+        for j in range(k_max + 1):
+            if neigh_inds[right_ind, j] == left_ind:
+                is_neighbor_mat[right_ind, max(j - 1, 0) :] = True
+                break
+
+
 def compute_neighbors_at_k(X, left_inds, right_inds, k_max=10):
-    nn = NearestNeighbors(radius=0, n_neighbors=k_max + 1, metric="cosine")
-    nn.fit(X)
-    neigh_dist, neigh_inds = nn.kneighbors(X)
+    # exact cosine kNN (including each point itself) from one gram matrix
+    X = np.asarray(X, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    X_norm = X / norms
+    sims = X_norm @ X_norm.T
+    neigh_inds = np.argpartition(-sims, kth=k_max, axis=1)[:, : k_max + 1]
+    neigh_sims = np.take_along_axis(sims, neigh_inds, axis=1)
+    neigh_inds = np.take_along_axis(neigh_inds, np.argsort(-neigh_sims, axis=1), axis=1)
     is_neighbor_mat = np.zeros((X.shape[0], k_max), dtype=bool)
-    for left_ind, right_ind in zip(left_inds, right_inds):
-        left_neigh_inds = neigh_inds[left_ind]
-        right_neigh_inds = neigh_inds[right_ind]
-        for k in range(k_max):
-            if right_ind in left_neigh_inds[: k + 2]:
-                is_neighbor_mat[left_ind, k] = True
-            if left_ind in right_neigh_inds[: k + 2]:
-                is_neighbor_mat[right_ind, k] = True
+    _fill_neighbors_at_k(
+        neigh_inds,
+        np.asarray(left_inds, dtype=np.int64),
+        np.asarray(right_inds, dtype=np.int64),
+        k_max,
+        is_neighbor_mat,
+    )
 
     neighbors_at_k = np.sum(is_neighbor_mat, axis=0) / is_neighbor_mat.shape[0]
     return neighbors_at_k
 
 
+def threshold_graph(edge_mask, base_meta, sources, targets, weights):
+    """Sparse (CSR) adjacency and meta for the largest weakly connected component of
+    the graph on the edges in `edge_mask`"""
+    n_base = len(base_meta)
+    adj = coo_matrix(
+        (weights[edge_mask], (sources[edge_mask], targets[edge_mask])),
+        shape=(n_base, n_base),
+    ).tocsr()
+    n_comps, comp_labels = connected_components(adj, directed=True, connection="weak")
+    if n_comps > 1:
+        lcc_inds = np.where(comp_labels == np.bincount(comp_labels).argmax())[0]
+        adj = adj[lcc_inds][:, lcc_inds]
+        meta = base_meta.iloc[lcc_inds].copy()
+    else:
+        meta = base_meta.copy()
+
+    # unpair nodes whose pair did not make it into the LCC
+    missing = (meta["Pair"] != -1) & ~meta["Pair"].isin(meta.index)
+    meta.loc[missing, ["Pair", "Pair ID"]] = -1
+    return adj, meta
+
+
+def sparse_pass_to_ranks(adj):
+    """Same as graspy's default "simple-nonzero" pass to ranks, but only sorts the
+    stored nonzeros of a sparse matrix"""
+    adj = csr_matrix(adj, copy=True)
+    adj.eliminate_zeros()
+    adj.data = rankdata(adj.data) / (adj.nnz + 1)
+    return adj
+
+
+def preprocess_adj(adj, use_spl=False):
+    """Column normalize and pass to ranks, as a CSR matrix. There is no "plus c" step:
+    the smallest entry is always 0 (a non-edge, or the diagonal of the shortest path
+    lengths), so adding it did nothing"""
+    adj = csc_matrix(adj, dtype=np.float64)
+    colsums = np.asarray(adj.sum(axis=0)).ravel()
+    colsums[colsums == 0] = 1
+    adj = sparse_pass_to_ranks(adj @ diags(1 / colsums))
+    if use_spl:
+        adj = csr_matrix(graph_shortest_path(adj))
+    return adj
+
+
+def run_threshold(
+    threshold,
+    edge_mask,
+    base_meta,
+    sources,
+    targets,
+    weights,
+    n_components=None,
+    embed="lse",
+    use_spl=False,
+):
+    adj, meta = threshold_graph(edge_mask, base_meta, sources, targets, weights)
+    n_verts = len(meta)
+
+    meta["Original index"] = range(len(meta))
+    is_left = (meta["Hemisphere"] == "L").values
+    left_inds = np.flatnonzero(is_left)
+    left_paired_inds = np.flatnonzero(is_left & (meta["Pair"] != -1).values)
+    right_paired_inds = meta.index.get_indexer(meta["Pair"].values[left_paired_inds])
+
+    adj = preprocess_adj(adj, use_spl=use_spl)
+    if embed == "lse":
+        latent = lse_svds(adj, n_components)
+    elif embed == "ase":
+        latent = ase(adj.toarray(), None, ptr=False)
+    # well past the accuracy of the embedding, and halves the Procrustes/kNN traffic
+    latent = np.ascontiguousarray(latent, dtype=np.float32)
+
+    left_paired_latent = latent[left_paired_inds]
+    right_paired_latent = latent[right_paired_inds]
+    R = procrustes(left_paired_latent, right_paired_latent)
+
+    diff = np.linalg.norm(left_paired_latent @ R - right_paired_latent, ord="fro")
+
+    rot_latent = latent.copy()
+    rot_latent[left_inds] = latent[left_inds] @ R
+
+    neigh_probs = compute_neighbors_at_k(
+        rot_latent, left_paired_inds, right_paired_inds, k_max=10
+    )
+
+    row = {
+        "threshold": threshold,
+        "Residual F-norm": diff,
+        "n_verts": n_verts,
+        "Norm. Resid. F-norm": diff / n_verts,
+    }
+    return row, neigh_probs, rot_latent, meta
+
+
 # %% [markdown]
 # # For now, do not do any kind of max symmetrize stuff
 graph_type = "Gad"
@@ -126,96 +286,50 @@ mg = mg.make_lcc()
 edgelist_df = mg.to_edgelist()
 edgelist_df["source"] = edgelist_df["source"].astype("int64")
 edgelist_df["target"] = edgelist_df["target"].astype("int64")
-max_pair_edges = edgelist_df.groupby("edge pair ID", sort=False)["weight"].max()
-edge_max_weight_map = dict(zip(max_pair_edges.index.values, max_pair_edges.values))
-edgelist_df["max_weight"] = itemgetter(*edgelist_df["edge pair ID"])(
-    edge_max_weight_map
+edgelist_df["max_weight"] = group_max(
+    edgelist_df["weight"].to_numpy(), edgelist_df["edge pair ID"]
 )
 temp_df = edgelist_df[edgelist_df["edge pair ID"] == 0]
 edgelist_df.loc[temp_df.index, "max_weight"] = temp_df["weight"]
 
-rows = []
-neigh_probs = []
+# node order for the thresholded graphs, and the edgelist as index/weight arrays
+base_meta = mg.meta
+sources = base_meta.index.get_indexer(edgelist_df["source"].astype("int64"))
+targets = base_meta.index.get_indexer(edgelist_df["target"].astype("int64"))
+weights = edgelist_df["weight"].to_numpy(dtype=np.float64)
+max_weights = edgelist_df["max_weight"].to_numpy()
+
 thresholds = np.linspace(0, 7, 8)
-for threshold in thresholds:
-    thresh_df = edgelist_df[edgelist_df["max_weight"] > threshold]
-    nodelist = list(mg.g.nodes())
-    nodelist = [int(i) for i in nodelist]
-    thresh_g = nx.from_pandas_edgelist(
-        thresh_df, edge_attr=True, create_using=nx.DiGraph
+results = Parallel(n_jobs=-1)(
+    delayed(run_threshold)(
+        threshold,
+        max_weights > threshold,
+        base_meta,
+        sources,
+        targets,
+        weights,
+        n_components=None,
+        embed=embed,
+        use_spl=use_spl,
     )
-    nx.set_node_attributes(thresh_g, mg.meta.to_dict(orient="index"))
-    thresh_g = get_lcc(thresh_g)
-    n_verts = len(thresh_g)
-
-    n_missing = 0
-    for n, data in thresh_g.nodes(data=True):
-        pair = data["Pair"]
-        pair_id = data["Pair ID"]
-        if pair != -1:
-            if pair not in thresh_g:
-                thresh_g.node[n]["Pair"] = -1
-                thresh_g.node[n]["Pair ID"] = -1
-                n_missing += 1
-
-    mg = MetaGraph(thresh_g)
-    meta = mg.meta
-    meta["Original index"] = range(len(meta))
-    left_paired_df = meta[(meta["Pair"] != -1) & (meta["Hemisphere"] == "L")]
-    left_paired_inds = left_paired_df["Original index"].values
-    pairs = left_paired_df["Pair"]
-    right_paired_inds = meta.loc[pairs, "Original index"].values
-    left_inds = meta[meta["Hemisphere"] == "L"]["Original index"].values
-    right_inds = meta[meta["Hemisphere"] == "R"]["Original index"].values
-
-    adj = mg.adj.copy()
-    colsums = np.sum(adj, axis=0)
-    colsums[colsums == 0] = 1
-    adj = adj / colsums[np.newaxis, :]
-    print(np.sum(adj, axis=0))
-    adj = pass_to_ranks(adj)
-    if use_spl:
-        adj = graph_shortest_path(adj)
-    if plus_c:
-        adj += 1 * np.min(adj)
-    # latent = LaplacianSpectralEmbed(form="R-DAD", n_components=None).fit_transform(adj)
-    # latent = np.concatenate(latent, axis=-1)
-
-    if embed == "lse":
-        latent = lse(adj, None, ptr=False)
-    elif embed == "ase":
-        latent = ase(adj, None, ptr=False)
-
-    left_paired_latent = latent[left_paired_inds]
-    right_paired_latent = latent[right_paired_inds]
-    R, scalar = orthogonal_procrustes(left_paired_latent, right_paired_latent)
-
-    n_components = latent.shape[1]
-
-    diff = np.linalg.norm(left_paired_latent @ R - right_paired_latent, ord="fro")
+    for threshold in thresholds
+)
+rows, neigh_probs, rot_latents, metas = zip(*results)
 
-    rot_latent = latent
-    rot_latent[left_inds] = latent[left_inds] @ R
+title = f"{graph_type}, SPL = {use_spl}, Embed = {embed}, + C = {plus_c}"
+base_save = f"-{graph_type}-spl{use_spl}-e{embed}-pc{plus_c}"
 
+fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+for threshold, row, rot_latent, meta in zip(thresholds, rows, rot_latents, metas):
+    ax.clear()
     plot_df = pd.DataFrame(data=rot_latent)
-    plot_df["Class"] = mg["Class 1"]
-    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+    plot_df["Class"] = meta["Class 1"].values
     sns.scatterplot(x=0, y=1, data=plot_df, hue="Class", legend=False, ax=ax)
+    diff = row["Residual F-norm"]
     ax.set_title(f"Residual F. norm = {diff}, threshold = {threshold}")
-
-    temp_neigh_probs = compute_neighbors_at_k(
-        rot_latent, left_paired_inds, right_paired_inds, k_max=10
-    )
-
-    neigh_probs.append(temp_neigh_probs)
-
-    row = {
-        "threshold": threshold,
-        "Residual F-norm": diff,
-        "n_verts": n_verts,
-        "Norm. Resid. F-norm": diff / n_verts,
-    }
-    rows.append(row)
+    stashfig(f"latent-thresh{threshold:.3g}" + base_save)
+plt.close(fig)
+latent = rot_latents[-1]
 
 
 neigh_mat = np.array(neigh_probs)
@@ -223,9 +337,6 @@ res_df = pd.DataFrame(rows)
 for i in range(1, 11):
     res_df[i] = neigh_mat[:, i - 1]
 
-title = f"{graph_type}, SPL = {use_spl}, Embed = {embed}, + C = {plus_c}"
-base_save = f"-{graph_type}-spl{use_spl}-e{embed}-pc{plus_c}"
-
 fig, ax = plt.subplots(1, 1, figsize=(10, 5))
 sns.scatterplot(x="threshold", y="Residual F-norm", data=res_df, legend=False, ax=ax)
 ax.set_title(title)
@@ -281,103 +392,58 @@ edgelist_df["norm_weight"] = (
     edgelist_df["syn_weight"] / edgelist_df["target dendrite_input"]
 )
 
-max_pair_edges = edgelist_df.groupby("edge pair ID", sort=False)["syn_weight"].max()
-edge_max_weight_map = dict(zip(max_pair_edges.index.values, max_pair_edges.values))
-edgelist_df["max_syn_weight"] = itemgetter(*edgelist_df["edge pair ID"])(
-    edge_max_weight_map
+edgelist_df["max_syn_weight"] = group_max(
+    edgelist_df["syn_weight"].to_numpy(), edgelist_df["edge pair ID"]
 )
 temp_df = edgelist_df[edgelist_df["edge pair ID"] == 0]
 edgelist_df.loc[temp_df.index, "max_syn_weight"] = temp_df["syn_weight"]
 
-max_pair_edges = edgelist_df.groupby("edge pair ID", sort=False)["norm_weight"].max()
-edge_max_weight_map = dict(zip(max_pair_edges.index.values, max_pair_edges.values))
-edgelist_df["max_norm_weight"] = itemgetter(*edgelist_df["edge pair ID"])(
-    edge_max_weight_map
+edgelist_df["max_norm_weight"] = group_max(
+    edgelist_df["norm_weight"].to_numpy(), edgelist_df["edge pair ID"]
 )
 temp_df = edgelist_df[edgelist_df["edge pair ID"] == 0]
 edgelist_df.loc[temp_df.index, "max_norm_weight"] = temp_df["norm_weight"]
 
+# node order for the thresholded graphs, and the edgelist as index/weight arrays
+base_meta = mg.meta
+sources = base_meta.index.get_indexer(edgelist_df["source"].astype("int64"))
+targets = base_meta.index.get_indexer(edgelist_df["target"].astype("int64"))
+weights = edgelist_df["max_norm_weight"].to_numpy(dtype=np.float64)
+max_syn_weights = edgelist_df["max_syn_weight"].to_numpy()
+max_norm_weights = edgelist_df["max_norm_weight"].to_numpy()
+
 
-rows = []
-neigh_probs = []
 thresholds = np.linspace(0, 0.05, 10)
-for threshold in thresholds:
-    thresh_df = edgelist_df[edgelist_df["max_syn_weight"] > 1]
-    thresh_df = thresh_df[thresh_df["max_norm_weight"] > threshold]
-    nodelist = list(mg.g.nodes())
-    nodelist = [int(i) for i in nodelist]
-    thresh_g = nx.from_pandas_edgelist(
-        thresh_df, edge_attr=True, create_using=nx.DiGraph
+results = Parallel(n_jobs=-1)(
+    delayed(run_threshold)(
+        threshold,
+        (max_syn_weights > 1) & (max_norm_weights > threshold),
+        base_meta,
+        sources,
+        targets,
+        weights,
+        n_components=None,
+        embed=embed,
+        use_spl=use_spl,
     )
-    nx.set_node_attributes(thresh_g, mg.meta.to_dict(orient="index"))
-    thresh_g = get_lcc(thresh_g)
-    n_verts = len(thresh_g)
-
-    n_missing = 0
-    for n, data in thresh_g.nodes(data=True):
-        pair = data["Pair"]
-        pair_id = data["Pair ID"]
-        if pair != -1:
-            if pair not in thresh_g:
-                thresh_g.node[n]["Pair"] = -1
-                thresh_g.node[n]["Pair ID"] = -1
-                n_missing += 1
-
-    mg = MetaGraph(thresh_g, weight="max_norm_weight")
-    meta = mg.meta
-    meta["Original index"] = range(len(meta))
-    left_paired_df = meta[(meta["Pair"] != -1) & (meta["Hemisphere"] == "L")]
-    left_paired_inds = left_paired_df["Original index"].values
-    pairs = left_paired_df["Pair"]
-    right_paired_inds = meta.loc[pairs, "Original index"].values
-    left_inds = meta[meta["Hemisphere"] == "L"]["Original index"].values
-    right_inds = meta[meta["Hemisphere"] == "R"]["Original index"].values
-
-    adj = mg.adj.copy()
-    colsums = np.sum(adj, axis=0)
-    colsums[colsums == 0] = 1
-    adj = adj / colsums[np.newaxis, :]
-    adj = pass_to_ranks(adj)
-    if use_spl:
-        adj = graph_shortest_path(adj)
-    if plus_c:
-        adj += np.min(adj)
-
-    if embed == "lse":
-        latent = lse(adj, None, ptr=False)
-    elif embed == "ase":
-        latent = ase(adj, None, ptr=False)
-
-    left_paired_latent = latent[left_paired_inds]
-    right_paired_latent = latent[right_paired_inds]
-    R, scalar = orthogonal_procrustes(left_paired_latent, right_paired_latent)
-
-    n_components = latent.shape[1]
-
-    diff = np.linalg.norm(left_paired_latent @ R - right_paired_latent, ord="fro")
+    for threshold in thresholds
+)
+rows, neigh_probs, rot_latents, metas = zip(*results)
 
-    rot_latent = latent
-    rot_latent[left_inds] = latent[left_inds] @ R
+title = f"{graph_type}, SPL = {use_spl}, Embed = {embed}, + C = {plus_c}"
+base_save = f"-{graph_type}-spl{use_spl}-e{embed}-pc{plus_c}"
 
+fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+for threshold, row, rot_latent, meta in zip(thresholds, rows, rot_latents, metas):
+    ax.clear()
     plot_df = pd.DataFrame(data=rot_latent)
-    plot_df["Class"] = mg["Class 1"]
-    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+    plot_df["Class"] = meta["Class 1"].values
     sns.scatterplot(x=0, y=1, data=plot_df, hue="Class", legend=False, ax=ax)
+    diff = row["Residual F-norm"]
     ax.set_title(f"Residual F. norm = {diff}, threshold = {threshold}")
-
-    temp_neigh_probs = compute_neighbors_at_k(
-        rot_latent, left_paired_inds, right_paired_inds, k_max=10
-    )
-
-    neigh_probs.append(temp_neigh_probs)
-
-    row = {
-        "threshold": threshold,
-        "Residual F-norm": diff,
-        "n_verts": n_verts,
-        "Norm. Resid. F-norm": diff / n_verts,
-    }
-    rows.append(row)
+    stashfig(f"latent-thresh{threshold:.3g}" + base_save)
+plt.close(fig)
+latent = rot_latents[-1]
 
 
 neigh_mat = np.array(neigh_probs)
@@ -385,9 +451,6 @@ res_df = pd.DataFrame(rows)
 for i in range(1, 11):
     res_df[i] = neigh_mat[:, i - 1]
 
-title = f"{graph_type}, SPL = {use_spl}, Embed = {embed}, + C = {plus_c}"
-base_save = f"-{graph_type}-spl{use_spl}-e{embed}-pc{plus_c}"
-
 fig, ax = plt.subplots(1, 1, figsize=(10, 5))
 sns.scatterplot(x="threshold", y="Residual F-norm", data=res_df, legend=False, ax=ax)
 ax.set_title(title)
@@ -427,8 +490,8 @@ stashfig(f"threshold-vs-knn" + base_save)
 
 # %%
 latent_cols = [f"dim {i}" for i in range(latent.shape[1])]
-latent_df = pd.DataFrame(data=latent, index=mg.meta.index, columns=latent_cols)
-latent_df = pd.concat((mg.meta, latent_df), axis=1)
+latent_df = pd.DataFrame(data=latent, index=meta.index, columns=latent_cols)
+latent_df = pd.concat((meta, latent_df), axis=1)
 latent_df.index.name = "Skeleton ID"
 out_file = f"maggot_models/notebooks/outs/{FNAME}/latent.csv"
 latent_df.to_csv(out_file)
@@ -197,19 +197,15 @@ for threshold in thresholds:
     thresh_g = nx.from_pandas_edgelist(
         thresh_df, edge_attr=True, create_using=nx.DiGraph
     )
-    nx.set_node_attributes(thresh_g, mg.meta.to_dict(orient="index"))
     thresh_g = get_lcc(thresh_g)
     n_verts = len(thresh_g)
 
-    n_missing = 0
-    for n, data in thresh_g.nodes(data=True):
-        pair = data["Pair"]
-        pair_id = data["Pair ID"]
-        if pair != -1:
-            if pair not in thresh_g:
-                thresh_g.node[n]["Pair"] = -1
-                thresh_g.node[n]["Pair ID"] = -1
-                n_missing += 1
+    # unpair nodes whose pair did not make it into the LCC
+    thresh_meta = mg.meta.loc[list(thresh_g.nodes)].copy()
+    missing = (thresh_meta["Pair"] != -1) & ~thresh_meta["Pair"].isin(thresh_meta.index)
+    n_missing = missing.sum()
+    thresh_meta.loc[missing, ["Pair", "Pair ID"]] = -1
+    nx.set_node_attributes(thresh_g, thresh_meta.to_dict(orient="index"))
 
     mg = MetaGraph(thresh_g, weight="max_norm_weight")
     meta = mg.meta
@@ -3,7 +3,6 @@
 import os
 import pickle
 import warnings
-from operator import itemgetter
 from pathlib import Path
 from timeit import default_timer as timer
 
@@ -21,22 +20,18 @@ from bokeh.models import ColumnDataSource, FactorRange, Legend, Span, PreText, C
 from bokeh.palettes import Spectral4, all_palettes
 from bokeh.plotting import curdoc, figure, output_file, show
 from bokeh.resources import CDN
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from matplotlib.cm import ScalarMappable
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from sklearn.metrics import adjusted_rand_score
 from sklearn.model_selection import ParameterGrid
-from sklearn.neighbors import NearestNeighbors
-from sklearn.utils.graph_shortest_path import graph_shortest_path
 from graspy.cluster import AutoGMMCluster, GaussianCluster
 from graspy.embed import AdjacencySpectralEmbed, LaplacianSpectralEmbed
-from graspy.utils import pass_to_ranks, get_lcc
 from graspy.plot import degreeplot, edgeplot, gridplot, heatmap, pairplot
 from graspy.utils import symmetrize
 from src.cluster import DivisiveCluster
 from src.data import load_everything, load_metagraph, load_networkx
 from src.embed import ase, lse, preprocess_graph
-from src.graph import MetaGraph
 from src.hierarchy import signal_flow
 from src.io import savefig, saveobj, saveskels
 from src.utils import (
@@ -58,7 +53,10 @@ from src.visualization import (
 from bokeh.models import Select
 from bokeh.palettes import Spectral5
 from bokeh.plotting import curdoc, figure
-from scipy.linalg import orthogonal_procrustes
+from scipy.linalg import svd
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.stats import rankdata
 
 
 FNAME = os.path.basename(__file__)[:-3]
@@ -90,19 +88,60 @@ def stashskel(name, ids, labels, colors=None, palette=None, **kws):
     )
 
 
+def sparse_pass_to_ranks(adj):
+    """Same as graspy's default "simple-nonzero" pass to ranks, but only sorts the
+    stored nonzeros of a sparse matrix"""
+    adj = csr_matrix(adj, copy=True)
+    adj.eliminate_zeros()
+    adj.data = rankdata(adj.data) / (adj.nnz + 1)
+    return adj
+
+
+def parallel_shortest_path(adj, n_jobs=-1):
+    """Dijkstra from batches of sources on threads (scipy releases the GIL), stacked
+    into the dense matrix of shortest path lengths"""
+    adj = csr_matrix(adj)
+    n_chunks = effective_n_jobs(n_jobs)
+    source_chunks = np.array_split(np.arange(adj.shape[0]), n_chunks)
+    path_lengths = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(dijkstra)(adj, directed=True, indices=chunk)
+        for chunk in source_chunks
+        if len(chunk) > 0
+    )
+    return np.concatenate(path_lengths, axis=0)
+
+
+def prepare_adj(adj, use_spl=False):
+    """Pass to ranks (and optionally shortest path lengths) on the sparse adjacency,
+    densified once into a single float32 array for the embedding"""
+    adj = sparse_pass_to_ranks(adj)
+    if use_spl:
+        adj = parallel_shortest_path(adj).astype(np.float32)
+        adj[np.isinf(adj)] = 0  # unreachable, as in sklearn's graph_shortest_path
+    else:
+        adj = adj.astype(np.float32).toarray()
+    # no "plus c": the smallest entry is always 0 (a non-edge, or the diagonal of the
+    # shortest path lengths), so adding it did nothing
+    return adj
+
+
 def compute_neighbors_at_k(X, left_inds, right_inds, k_max=10):
-    nn = NearestNeighbors(radius=0, n_neighbors=k_max + 1)  # metric="cosine")
-    nn.fit(X)
-    neigh_dist, neigh_inds = nn.kneighbors(X)
+    # exact euclidean kNN (including each point itself) by brute force, from one GEMM
+    sq_norms = np.einsum("ij,ij->i", X, X)
+    dists = sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2 * X @ X.T
+    neigh_inds = np.argpartition(dists, kth=k_max, axis=1)[:, : k_max + 1]
+    neigh_dists = np.take_along_axis(dists, neigh_inds, axis=1)
+    neigh_inds = np.take_along_axis(neigh_inds, np.argsort(neigh_dists, axis=1), axis=1)
     is_neighbor_mat = np.zeros((X.shape[0], k_max), dtype=bool)
-    for left_ind, right_ind in zip(left_inds, right_inds):
-        left_neigh_inds = neigh_inds[left_ind]
-        right_neigh_inds = neigh_inds[right_ind]
-        for k in range(k_max):
-            if right_ind in left_neigh_inds[: k + 2]:
-                is_neighbor_mat[left_ind, k] = True
-            if left_ind in right_neigh_inds[: k + 2]:
-                is_neighbor_mat[right_ind, k] = True
+    left_inds = np.asarray(left_inds)
+    right_inds = np.asarray(right_inds)
+    ks = np.arange(1, k_max + 1)
+    for query_inds, pair_inds in [(left_inds, right_inds), (right_inds, left_inds)]:
+        # a pair is within k neighbors (after the point itself) from the first position
+        # it shows up at in the neighbor list
+        is_pair = neigh_inds[query_inds] == pair_inds[:, np.newaxis]
+        pair_pos = np.where(is_pair.any(axis=1), is_pair.argmax(axis=1), k_max + 1)
+        np.logical_or.at(is_neighbor_mat, query_inds, pair_pos[:, np.newaxis] <= ks)
 
     neighbors_at_k = np.sum(is_neighbor_mat, axis=0) / is_neighbor_mat.shape[0]
     return neighbors_at_k
@@ -126,8 +165,17 @@ def procrustes_match(latent, meta):
     left_paired_latent = latent[left_paired_inds]
     right_paired_latent = latent[right_paired_inds]
 
-    R, scalar = orthogonal_procrustes(left_paired_latent, right_paired_latent)
-    diff = np.linalg.norm(left_paired_latent @ R - right_paired_latent, ord="fro")
+    # same R as orthogonal_procrustes, from the SVD of the small d x d cross product
+    M = left_paired_latent.T @ right_paired_latent
+    U, sing_vals, Vt = svd(M, lapack_driver="gesdd", full_matrices=False)
+    R = U @ Vt
+    # at the optimal R, ||XR - Y||^2 = ||X||^2 + ||Y||^2 - 2 * (sum of singular values)
+    sq_diff = (
+        np.sum(left_paired_latent ** 2)
+        + np.sum(right_paired_latent ** 2)
+        - 2 * np.sum(sing_vals)
+    )
+    diff = np.sqrt(max(sq_diff, 0))
 
     rot_latent = latent
     rot_latent[left_inds] = latent[left_inds] @ R
@@ -204,23 +252,14 @@ def preprocess(mg, remove_pdiff=True):
         edgelist_df["syn_weight"] / edgelist_df["target dendrite_input"]
     )
 
-    max_pair_edges = edgelist_df.groupby("edge pair ID", sort=False)["syn_weight"].max()
-    edge_max_weight_map = dict(zip(max_pair_edges.index.values, max_pair_edges.values))
-    edgelist_df["max_syn_weight"] = itemgetter(*edgelist_df["edge pair ID"])(
-        edge_max_weight_map
-    )
-    temp_df = edgelist_df[edgelist_df["edge pair ID"] == 0]
-    edgelist_df.loc[temp_df.index, "max_syn_weight"] = temp_df["syn_weight"]
-
-    max_pair_edges = edgelist_df.groupby("edge pair ID", sort=False)[
-        "norm_weight"
-    ].max()
-    edge_max_weight_map = dict(zip(max_pair_edges.index.values, max_pair_edges.values))
-    edgelist_df["max_norm_weight"] = itemgetter(*edgelist_df["edge pair ID"])(
-        edge_max_weight_map
-    )
-    temp_df = edgelist_df[edgelist_df["edge pair ID"] == 0]
-    edgelist_df.loc[temp_df.index, "max_norm_weight"] = temp_df["norm_weight"]
+    # max over each edge pair, except edge pair ID 0, which keeps its own weight
+    edge_pair_ids = edgelist_df["edge pair ID"]
+    groups = edgelist_df.groupby("edge pair ID", sort=False)
+    for col in ["syn_weight", "norm_weight"]:
+        max_weights = groups[col].transform("max")
+        edgelist_df["max_" + col] = max_weights.where(
+            edge_pair_ids != 0, edgelist_df[col]
+        )
     return edgelist_df
 
 
@@ -231,44 +270,47 @@ def preprocess(mg, remove_pdiff=True):
 
 # %% [markdown]
 # #
-rows = []
-neigh_probs = []
-thresholds = np.linspace(0, 6, 7)
-for threshold in thresholds:
-    thresh_df = edgelist_df[edgelist_df["max_norm_weight"] > 1]
-    # thresh_df = edgelist_df.copy()
-    thresh_df = thresh_df[thresh_df["max_syn_weight"] > threshold]
-    nodelist = list(mg.g.nodes())
-    nodelist = [int(i) for i in nodelist]
-    thresh_g = nx.from_pandas_edgelist(
-        thresh_df, edge_attr=True, create_using=nx.DiGraph
-    )
-    nx.set_node_attributes(thresh_g, mg.meta.to_dict(orient="index"))
-    thresh_g = get_lcc(thresh_g)
-    n_verts = len(thresh_g)
-
-    n_missing = 0
-    for n, data in thresh_g.nodes(data=True):
-        pair = data["Pair"]
-        pair_id = data["Pair ID"]
-        if pair != -1:
-            if pair not in thresh_g:
-                thresh_g.node[n]["Pair"] = -1
-                thresh_g.node[n]["Pair ID"] = -1
-                n_missing += 1
-
-    mg = MetaGraph(thresh_g, weight="max_norm_weight")
-    meta = mg.meta
-
-    adj = mg.adj.copy()
+# sort the edges by the thresholded weight once, so each threshold keeps a suffix
+edgelist_df = edgelist_df[edgelist_df["max_norm_weight"] > 1]
+base_meta = mg.meta
+edge_sort = np.argsort(edgelist_df["max_syn_weight"].values, kind="stable")
+sorted_max_weights = edgelist_df["max_syn_weight"].values[edge_sort]
+sources = base_meta.index.get_indexer(edgelist_df["source"].astype("int64"))
+sources = sources[edge_sort]
+targets = base_meta.index.get_indexer(edgelist_df["target"].astype("int64"))
+targets = targets[edge_sort]
+weights = edgelist_df["max_norm_weight"].to_numpy(dtype=np.float64)[edge_sort]
+
+
+def run_threshold(
+    threshold,
+    sorted_max_weights,
+    sources,
+    targets,
+    weights,
+    base_meta,
+    embed="lse",
+    use_spl=False,
+):
+    n_base = len(base_meta)
+    first_edge = np.searchsorted(sorted_max_weights, threshold, side="right")
+    adj = coo_matrix(
+        (weights[first_edge:], (sources[first_edge:], targets[first_edge:])),
+        shape=(n_base, n_base),
+    ).tocsr()
+    _, comp_labels = connected_components(adj, directed=True, connection="weak")
+    lcc_inds = np.flatnonzero(comp_labels == np.bincount(comp_labels).argmax())
+    meta = base_meta.iloc[lcc_inds].copy()
+    # unpair nodes whose pair did not make it into the LCC
+    missing = (meta["Pair"] != -1) & ~meta["Pair"].isin(meta.index)
+    meta.loc[missing, ["Pair", "Pair ID"]] = -1
+    adj = adj[lcc_inds][:, lcc_inds]
+    n_verts = len(meta)
+
     # colsums = np.sum(adj, axis=0)
     # colsums[colsums == 0] = 1
     # adj = adj / colsums[np.newaxis, :]
-    adj = pass_to_ranks(adj)
-    if use_spl:
-        adj = graph_shortest_path(adj)
-    if plus_c:
-        adj += np.min(adj)
+    adj = prepare_adj(adj, use_spl=use_spl)
 
     if embed == "lse":
         latent = lse(adj, None, ptr=False)
@@ -277,29 +319,47 @@ for threshold in thresholds:
 
     rot_latent, diff = procrustes_match(latent, meta)
     rot_latent = latent
-    n_components = latent.shape[1]
-
-    plot_df = pd.DataFrame(data=rot_latent)
-    plot_df["Class"] = mg["Class 1"]
-    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
-    sns.scatterplot(x=0, y=1, data=plot_df, hue="Class", legend=False, ax=ax)
-    ax.set_title(f"Residual F. norm = {diff}, threshold = {threshold}")
 
     left_paired_inds, right_paired_inds = get_paired_inds(meta)
-    temp_neigh_probs = compute_neighbors_at_k(
+    neigh_probs = compute_neighbors_at_k(
         rot_latent, left_paired_inds, right_paired_inds, k_max=10
     )
 
-    neigh_probs.append(temp_neigh_probs)
-
     row = {
         "threshold": threshold,
         "Residual F-norm": diff,
         "n_verts": n_verts,
         "Norm. Resid. F-norm": diff / n_verts,
     }
-    rows.append(row)
+    return row, neigh_probs, rot_latent, meta
+
+
+# the thresholds are independent, so run them in parallel. the edge arrays are big
+# enough that joblib memmaps them for the workers instead of pickling per task
+thresholds = np.linspace(0, 6, 7)
+results = Parallel(n_jobs=min(len(thresholds), os.cpu_count()), backend="loky")(
+    delayed(run_threshold)(
+        threshold,
+        sorted_max_weights,
+        sources,
+        targets,
+        weights,
+        base_meta,
+        embed=embed,
+        use_spl=use_spl,
+    )
+    for threshold in thresholds
+)
+rows, neigh_probs, rot_latents, metas = zip(*results)
 
+for threshold, row, rot_latent, meta in zip(thresholds, rows, rot_latents, metas):
+    plot_df = pd.DataFrame(data=rot_latent)
+    plot_df["Class"] = meta["Class 1"].values
+    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+    sns.scatterplot(x=0, y=1, data=plot_df, hue="Class", legend=False, ax=ax)
+    diff = row["Residual F-norm"]
+    ax.set_title(f"Residual F. norm = {diff}, threshold = {threshold}")
+latent = rot_latents[-1]
 
 neigh_mat = np.array(neigh_probs)
 res_df = pd.DataFrame(rows)
@@ -348,8 +408,8 @@ stashfig(f"threshold-vs-knn" + base_save)
 
 # %%
 latent_cols = [f"dim {i}" for i in range(latent.shape[1])]
-latent_df = pd.DataFrame(data=latent, index=mg.meta.index, columns=latent_cols)
-latent_df = pd.concat((mg.meta, latent_df), axis=1)
+latent_df = pd.DataFrame(data=latent, index=meta.index, columns=latent_cols)
+latent_df = pd.concat((meta, latent_df), axis=1)
 latent_df.index.name = "Skeleton ID"
 out_file = f"maggot_models/notebooks/outs/{FNAME}/latent.csv"
 latent_df.to_csv(out_file)
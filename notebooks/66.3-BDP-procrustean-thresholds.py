@@ -189,6 +189,9 @@ len(edgelist_df)
 
 rows = []
 neigh_probs = []
+# node attributes don't depend on the threshold, so only build these once
+base_meta = mg.meta
+meta_dict = base_meta.to_dict(orient="index")
 thresholds = np.linspace(0, 6, 7)
 for threshold in thresholds:
     thresh_df = edgelist_df[edgelist_df["max_norm_weight"] > 0.001]
@@ -198,19 +201,18 @@ for threshold in thresholds:
     thresh_g = nx.from_pandas_edgelist(
         thresh_df, edge_attr=True, create_using=nx.DiGraph
     )
-    nx.set_node_attributes(thresh_g, mg.meta.to_dict(orient="index"))
     thresh_g = get_lcc(thresh_g)
     n_verts = len(thresh_g)
 
-    n_missing = 0
-    for n, data in thresh_g.nodes(data=True):
-        pair = data["Pair"]
-        pair_id = data["Pair ID"]
-        if pair != -1:
-            if pair not in thresh_g:
-                thresh_g.node[n]["Pair"] = -1
-                thresh_g.node[n]["Pair ID"] = -1
-                n_missing += 1
+    # unpair nodes whose pair did not make it into the LCC
+    thresh_nodes = list(thresh_g.nodes)
+    pairs = base_meta.loc[thresh_nodes, "Pair"].values
+    missing = (pairs != -1) & ~np.isin(pairs, thresh_nodes)
+    n_missing = missing.sum()
+    node_attrs = {n: meta_dict[n] for n in thresh_nodes}
+    for n in np.array(thresh_nodes)[missing]:
+        node_attrs[n] = {**meta_dict[n], "Pair": -1, "Pair ID": -1}
+    nx.set_node_attributes(thresh_g, node_attrs)
 
     mg = MetaGraph(thresh_g, weight="max_norm_weight")
     meta = mg.meta
@@ -15,7 +15,7 @@ import seaborn as sns
 import textdistance
 from joblib import Parallel, delayed
 from scipy.cluster.hierarchy import dendrogram, fcluster, linkage
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import dijkstra
 from scipy.spatial.distance import squareform
 from sklearn.cluster import AgglomerativeClustering
@@ -29,6 +29,11 @@ from src.data import load_metagraph
 from src.embed import ase, lse, preprocess_graph
 from src.graph import MetaGraph, preprocess
 from src.io import savecsv, savefig, saveskels
+from src.traverse import (
+    generate_random_walks_flat,
+    path_to_median_visits,
+    to_markov_matrix,
+)
 from src.visualization import (
     CLASS_COLOR_DICT,
     barplot_text,
@@ -83,41 +88,6 @@ def pairwise_sparse_jaccard_distance(X, Y=None):
     return (1 - intersect / union).A
 
 
-def generate_random_walks(prob_mat, from_inds, out_inds, n_walks=100, max_walk=25):
-    n_verts = len(prob_mat)
-    dead_inds = np.where(prob_mat.sum(axis=1) == 0)[0]
-    stop_reasons = np.zeros(3)
-    sm_paths = []
-    visit_orders = {i: [] for i in range(n_verts)}
-    for s in from_inds:
-        for n in range(n_walks):
-            curr_ind = s
-            n_steps = 0
-            path = [s]
-            visit_orders[s].append(len(path))
-            while (
-                (curr_ind not in out_inds)
-                and (n_steps <= max_walk)
-                and (curr_ind not in dead_inds)
-            ):
-                next_ind = np.random.choice(n_verts, p=prob_mat[curr_ind])
-                n_steps += 1
-                curr_ind = next_ind
-                path.append(curr_ind)
-                visit_orders[curr_ind].append(len(path))
-            if curr_ind in out_inds:
-                stop_reasons[0] += 1
-                sm_paths.append(path)
-            if curr_ind in dead_inds:
-                stop_reasons[1] += 1
-            if n_steps > max_walk:
-                stop_reasons[2] += 1
-
-    print(stop_reasons / stop_reasons.sum())
-    print(len(sm_paths))
-    return sm_paths, visit_orders
-
-
 #%% Load and preprocess the data
 
 VERSION = "2020-01-29"
@@ -148,14 +118,11 @@ out_classes = [
 ]
 sens_classes = ["sens"]
 
-adj = nx.to_numpy_array(mg.g, weight=weight, nodelist=mg.meta.index.values)
-prob_mat = adj.copy()
-row_sums = prob_mat.sum(axis=1)
-dead_inds = np.where(row_sums == 0)[0]
-row_sums[row_sums == 0] = 1
-prob_mat = prob_mat / row_sums[:, np.newaxis]
-
-n_verts = len(prob_mat)
+adj = nx.to_scipy_sparse_matrix(
+    mg.g, weight=weight, nodelist=mg.meta.index.values, format="csr"
+)
+prob_mat = to_markov_matrix(adj, dtype=np.float32)
+n_verts = prob_mat.shape[0]
 meta = mg.meta.copy()
 g = mg.g.copy()
 meta["idx"] = range(len(meta))
@@ -175,34 +142,24 @@ max_walk = 25
 
 t = time.time()
 
-sm_paths, visit_orders = generate_random_walks(
-    prob_mat, from_inds, out_inds, n_walks=n_walks, max_walk=25
+flat_paths, offsets, visit_medians, visit_counts = generate_random_walks_flat(
+    prob_mat, from_inds, out_inds, n_walks=n_walks, max_walk=25, return_visits=True
 )
+sm_paths = np.split(flat_paths, offsets[1:-1])
 
 print(f"{time.time() - t} elapsed seconds")
 # %% [markdown]
 # #
-out_orders = {i: [] for i in range(n_verts)}
-
-for path in sm_paths:
-    for i, n in enumerate(path):
-        out_orders[n].append(len(path) - i)
+out_medians, _ = path_to_median_visits(
+    flat_paths, n_verts, from_order=False, offsets=offsets
+)
 
 
 # %% [markdown]
 # # Figure - median visit order
-meta["median_visit"] = -1
-meta["n_visits"] = 0
-
-for node_ind, visits in visit_orders.items():
-    median_order = np.median(visits)
-    meta.iloc[node_ind, meta.columns.get_loc("median_visit")] = median_order
-    meta.iloc[node_ind, meta.columns.get_loc("n_visits")] = len(visits)
-
-meta["median_out"] = -1
-for node_ind, visits in out_orders.items():
-    median_order = np.median(visits)
-    meta.iloc[node_ind, meta.columns.get_loc("median_out")] = median_order
+meta["median_visit"] = visit_medians
+meta["n_visits"] = visit_counts
+meta["median_out"] = out_medians
 
 sort_class = "Merge Class"
 class_rank = meta.groupby(sort_class)["median_visit"].median()
@@ -497,10 +454,12 @@ stashfig("sorted-adj", dpi=300)
 
 # %% [markdown]
 # # Try with Jaccard or something
-path_mat = lil_matrix((len(sm_paths), n_verts))
-for i, p in enumerate(sm_paths):
-    path_mat[i, p] = True
-path_csr = path_mat.tocsr()
+# the flat paths and offsets are already the indices and indptr of a CSR matrix
+path_csr = csr_matrix(
+    (np.ones(len(flat_paths)), flat_paths, offsets), shape=(len(sm_paths), n_verts)
+)
+path_csr.sum_duplicates()
+path_csr.data[:] = 1
 
 # %% [markdown]
 # #
@@ -532,9 +491,7 @@ print(f"{time.time() - t} elapsed seconds")
 # %% [markdown]
 # #
 paths = sm_paths
-path_start_labels = []
-path_start_labels = [p[0] for p in paths]
-path_start_labels = np.array(path_start_labels)
+path_start_labels = flat_paths[offsets[:-1]]
 
 #%%
 class_start_labels = meta.iloc[
@@ -30,7 +30,11 @@ from src.data import load_metagraph
 from src.embed import ase, lse, preprocess_graph
 from src.graph import MetaGraph, preprocess
 from src.io import savecsv, savefig, saveskels
-from src.traverse import generate_random_walks, to_markov_matrix
+from src.traverse import (
+    generate_random_walks_flat,
+    path_to_median_visits,
+    to_markov_matrix,
+)
 from src.visualization import (
     CLASS_COLOR_DICT,
     barplot_text,
@@ -90,9 +94,11 @@ else:
 class_key = "Class 1"
 sens_classes = ["sens"]  # ["sens-ORN"]
 
-adj = nx.to_numpy_array(mg.g, weight=weight, nodelist=mg.meta.index.values)
-prob_mat = to_markov_matrix(adj)
-n_verts = len(prob_mat)
+adj = nx.to_scipy_sparse_matrix(
+    mg.g, weight=weight, nodelist=mg.meta.index.values, format="csr"
+)
+prob_mat = to_markov_matrix(adj, dtype=np.float32)
+n_verts = prob_mat.shape[0]
 meta = mg.meta.copy()
 g = mg.g.copy()
 meta["idx"] = range(len(meta))
@@ -115,42 +121,33 @@ max_walk = 25
 
 t = time.time()
 
-sm_paths, visit_orders = generate_random_walks(
-    prob_mat, from_inds, out_inds, n_walks=n_walks, max_walk=25
+flat_paths, offsets, visit_medians, visit_counts = generate_random_walks_flat(
+    prob_mat, from_inds, out_inds, n_walks=n_walks, max_walk=25, return_visits=True
 )
 
 print(f"{time.time() - t} elapsed seconds")
 
 
-n_with_loops = 0
-for path in sm_paths:
-    if len(np.unique(path)) < len(path):
-        n_with_loops += 1
-print(100 * (n_with_loops / len(sm_paths)))
+# a path has a loop if it has fewer unique (path, node) visits than steps
+path_lens = np.diff(offsets)
+path_ids = np.repeat(np.arange(len(path_lens)), path_lens)
+uni_visits = np.unique(path_ids * n_verts + flat_paths)
+n_uni_visits = np.bincount(uni_visits // n_verts, minlength=len(path_lens))
+n_with_loops = np.count_nonzero(n_uni_visits < path_lens)
+print(100 * (n_with_loops / len(path_lens)))
 
 # %% [markdown]
 # #
-out_orders = {i: [] for i in range(n_verts)}
-
-for path in sm_paths:
-    for i, n in enumerate(path):
-        out_orders[n].append(len(path) - i)
+out_medians, _ = path_to_median_visits(
+    flat_paths, n_verts, from_order=False, offsets=offsets
+)
 
 
 # %% [markdown]
 # # Get median visit order
-meta["median_visit"] = -1
-meta["n_visits"] = 0
-
-for node_ind, visits in visit_orders.items():
-    median_order = np.median(visits)
-    meta.iloc[node_ind, meta.columns.get_loc("median_visit")] = median_order
-    meta.iloc[node_ind, meta.columns.get_loc("n_visits")] = len(visits)
-
-meta["median_out"] = -1
-for node_ind, visits in out_orders.items():
-    median_order = np.median(visits)
-    meta.iloc[node_ind, meta.columns.get_loc("median_out")] = median_order
+meta["median_visit"] = visit_medians
+meta["n_visits"] = visit_counts
+meta["median_out"] = out_medians
 
 sort_class = "Merge Class"
 class_rank = meta.groupby(sort_class)["median_visit"].median()
@@ -9,7 +9,6 @@ import colorcet as cc
 import matplotlib.colors as mplc
 import matplotlib.pyplot as plt
 import networkx as nx
-import numpy as np
 import pandas as pd
 import seaborn as sns
 import textdistance
@@ -25,7 +24,7 @@ from src.io import savecsv, savefig, saveskels
 from src.traverse import (
     generate_random_cascade,
     generate_random_walks,
-    path_to_visits,
+    path_to_median_visits,
     to_markov_matrix,
     to_path_graph,
 )
@@ -135,15 +134,9 @@ sns.distplot(lens[:10000], kde=False)
 # %% [markdown]
 # #
 
-meta["median_visit"] = -1
-meta["n_visits"] = 0
-
-visit_orders = path_to_visits(paths, n_verts)
-
-for node_ind, visits in visit_orders.items():
-    median_order = np.median(visits)
-    meta.iloc[node_ind, meta.columns.get_loc("median_visit")] = median_order
-    meta.iloc[node_ind, meta.columns.get_loc("n_visits")] = len(visits)
+median_visits, n_visits = path_to_median_visits(paths, n_verts)
+meta["median_visit"] = median_visits
+meta["n_visits"] = n_visits
 
 
 # %% [markdown]
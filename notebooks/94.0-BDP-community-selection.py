@@ -60,30 +60,33 @@ def stashcsv(df, name, **kws):
     savecsv(df, name, foldername=FNAME, save_on=True, **kws)
 
 
-def compute_ari(idx, param_df, classes, class_type="Class 1", remove_non_mb=False):
-    preprocess_params = dict(param_df.loc[idx, ["binarize", "threshold"]])
-    graph_type = param_df.loc[idx, "graph_type"]
+def get_preprocessed_meta(graph_type, binarize, threshold):
     mg = load_metagraph(graph_type, version=BRAIN_VERSION)
-    mg = preprocess(mg, sym_threshold=True, remove_pdiff=True, **preprocess_params)
-    left_mb_indicator = mg.meta[class_type].isin(classes) & (
-        mg.meta["Hemisphere"] == "L"
+    mg = preprocess(
+        mg,
+        sym_threshold=True,
+        remove_pdiff=True,
+        binarize=binarize,
+        threshold=threshold,
     )
-    right_mb_indicator = mg.meta[class_type].isin(classes) & (
-        mg.meta["Hemisphere"] == "R"
-    )
-    labels = np.zeros(len(mg.meta))
+    return mg.meta
+
+
+def compute_ari(idx, meta, classes, class_type="Class 1", remove_non_mb=False):
+    """`meta` is the output of `get_preprocessed_meta` for the parameters of `idx`"""
+    left_mb_indicator = meta[class_type].isin(classes) & (meta["Hemisphere"] == "L")
+    right_mb_indicator = meta[class_type].isin(classes) & (meta["Hemisphere"] == "R")
+    labels = np.zeros(len(meta))
     labels[left_mb_indicator.values] = 1
     labels[right_mb_indicator.values] = 2
-    pred_labels = best_block_df[idx]
-    pred_labels = pred_labels[pred_labels.index.isin(mg.meta.index)]
-    assert np.array_equal(pred_labels.index, mg.meta.index), print(idx)
+    pred_locs = best_block_df.index.get_indexer(meta.index)
+    assert (pred_locs != -1).all(), print(idx)
+    pred_labels = best_block_df[idx].values[pred_locs]
+    _, pred_labels = np.unique(pred_labels, return_inverse=True)
 
     if remove_non_mb:  # only consider ARI for clusters with some MB mass
-        uni_pred = np.unique(pred_labels)
-        keep_mask = np.ones(len(labels), dtype=bool)
-        for p in uni_pred:
-            if np.sum(labels[pred_labels == p]) == 0:
-                keep_mask[pred_labels == p] = False
+        cluster_mass = np.bincount(pred_labels, weights=labels)
+        keep_mask = cluster_mass[pred_labels] > 0
         labels = labels[keep_mask]
         pred_labels = pred_labels[keep_mask]
 
@@ -96,36 +99,24 @@ def compute_pairedness(partition, meta, holdout=None, rand_adjust=False, plot=Fa
     partition = partition.copy()
     meta = meta.copy()
 
-    if holdout is not None:
-        keep_inds = meta[~meta["Pair ID"].isin(holdout)].index
-        test_inds = meta[meta["Pair ID"].isin(holdout)].index
-        # partition = partition.loc[keep_inds]
-
     uni_labels, inv = np.unique(partition, return_inverse=True)
-
-    train_int_mat = np.zeros((len(uni_labels), len(uni_labels)))
-    test_int_mat = np.zeros((len(uni_labels), len(uni_labels)))
+    n_labels = len(uni_labels)
     meta = meta.loc[partition.index]
 
-    for i, ul in enumerate(uni_labels):
-        c1_mask = inv == i
-
-        c1_pairs = meta.loc[c1_mask, "Pair"]
-        c1_pairs.drop(
-            c1_pairs[c1_pairs == -1].index
-        )  # HACK must be a better pandas sol
-
-        for j, ul in enumerate(uni_labels):
-            c2_mask = inv == j
-            c2_inds = meta.loc[c2_mask].index
-            train_pairs_in_other = np.sum(
-                c1_pairs.isin(c2_inds) & c1_pairs.index.isin(keep_inds)
-            )
-            test_pairs_in_other = np.sum(
-                c1_pairs.isin(c2_inds) & c1_pairs.index.isin(test_inds)
-            )
-            train_int_mat[i, j] = train_pairs_in_other
-            test_int_mat[i, j] = test_pairs_in_other
+    if holdout is not None:
+        is_test = meta["Pair ID"].isin(holdout).values
+    else:
+        is_test = np.zeros(len(meta), dtype=bool)
+
+    # tally (cluster, cluster of pair) over the nodes whose pair is in the partition
+    pair_locs = partition.index.get_indexer(meta["Pair"])
+    has_pair = pair_locs != -1
+    pair_codes = inv * n_labels + inv[pair_locs]
+    n_bins = n_labels ** 2
+    train_int_mat = np.bincount(pair_codes[has_pair & ~is_test], minlength=n_bins)
+    train_int_mat = train_int_mat.reshape(n_labels, n_labels)
+    test_int_mat = np.bincount(pair_codes[has_pair & is_test], minlength=n_bins)
+    test_int_mat = test_int_mat.reshape(n_labels, n_labels)
 
     row_ind, col_ind = linear_sum_assignment(train_int_mat, maximize=True)
     train_pairedness = np.trace(train_int_mat[np.ix_(row_ind, col_ind)]) / np.sum(
@@ -190,12 +181,25 @@ best_param_df = param_df.loc[max_inds]
 best_block_df = block_df[max_inds]
 n_runs = len(max_inds)
 
+# %% [markdown]
+# # Preprocess each distinct graph once, rather than once per job
+
+preprocess_keys = ["graph_type", "binarize", "threshold"]
+key_df = best_param_df[preprocess_keys].drop_duplicates()
+preprocessed_metas = {
+    tuple(key): get_preprocessed_meta(*key) for key in key_df.itertuples(index=False)
+}
+best_metas = [
+    preprocessed_metas[tuple(best_param_df.loc[i, preprocess_keys])]
+    for i in best_param_df.index
+]
+
 # %% [markdown]
 # # Compute ARI relative to MB
 
 aris = Parallel(n_jobs=-2, verbose=10)(
-    delayed(compute_ari)(i, best_param_df, mb_classes, "Class 1")
-    for i in best_param_df.index
+    delayed(compute_ari)(i, meta, mb_classes, "Class 1")
+    for i, meta in zip(best_param_df.index, best_metas)
 )
 best_param_df["MB-ARI"] = aris
 
@@ -203,8 +207,8 @@ best_param_df["MB-ARI"] = aris
 # #
 
 aris = Parallel(n_jobs=-2, verbose=10)(
-    delayed(compute_ari)(i, best_param_df, al_classes, "Merge Class")
-    for i in best_param_df.index
+    delayed(compute_ari)(i, meta, al_classes, "Merge Class")
+    for i, meta in zip(best_param_df.index, best_metas)
 )
 best_param_df["AL-ARI"] = aris
 
@@ -21,11 +21,11 @@ from graspy.utils import get_lcc, symmetrize
 from src.data import load_metagraph
 from src.embed import ase, lse, preprocess_graph
 from src.graph import MetaGraph, preprocess
-from src.io import savecsv, savefig, saveskels, savelol
+from src.io import readpaths, savecsv, savefig, savepaths, saveskels
 from src.traverse import (
     generate_random_cascade,
-    generate_random_walks,
-    path_to_visits,
+    generate_random_walks_flat,
+    path_to_median_visits,
     to_markov_matrix,
     to_path_graph,
 )
@@ -50,8 +50,8 @@ def stashcsv(df, name, **kws):
     savecsv(df, name, foldername=FNAME, save_on=True, **kws)
 
 
-def stashlol(df, name, **kws):
-    savelol(df, name, foldername=FNAME, save_on=True, **kws)
+def stashpaths(flat_paths, offsets, name, **kws):
+    savepaths(flat_paths, offsets, name, foldername=FNAME, save_on=True, **kws)
 
 
 #%% Load and preprocess the data
@@ -110,14 +110,13 @@ sens_groups = [
     )
 ]
 
-adj = nx.to_numpy_array(mg.g, weight=weight, nodelist=mg.meta.index.values)
-n_verts = len(adj)
+adj = nx.to_scipy_sparse_matrix(
+    mg.g, weight=weight, nodelist=mg.meta.index.values, format="csr"
+)
+n_verts = adj.shape[0]
 meta = mg.meta.copy()
-g = mg.g.copy()
 meta["idx"] = range(len(meta))
-ind_map = dict(zip(meta.index, meta["idx"]))
-g = nx.relabel_nodes(g, ind_map, copy=True)
-prob_mat = to_markov_matrix(adj)
+prob_mat = to_markov_matrix(adj, dtype=np.float32)
 n_walks = 1000
 max_walk = 30
 
@@ -128,7 +127,6 @@ max_walk = 30
 # %% [markdown]
 # ## Generate paths SOMEHOW
 
-import csv
 from sklearn.model_selection import ParameterGrid
 
 basename = (
@@ -136,11 +134,11 @@ basename = (
 )
 
 
-def run_random_walks(sens_classes=None, out_classes=None, seed=None):
+def run_random_walks(prob_mat, sens_classes=None, out_classes=None, seed=None):
     np.random.seed(seed)
     from_inds = meta[meta[class_key].isin(sens_classes)]["idx"].values
     out_inds = meta[meta[class_key].isin(out_classes)]["idx"].values
-    paths, _ = generate_random_walks(
+    flat_paths, offsets = generate_random_walks_flat(
         prob_mat,
         from_inds,
         out_inds,
@@ -148,8 +146,8 @@ def run_random_walks(sens_classes=None, out_classes=None, seed=None):
         max_walk=max_walk,
         return_stuck=True,
     )
-    stashlol(paths, basename + f"{sens_classes}-{out_classes}")
-    return paths
+    stashpaths(flat_paths, offsets, basename + f"{sens_classes}-{out_classes}")
+    return flat_paths, offsets
 
 
 np.random.seed(8888889)
@@ -171,22 +169,16 @@ print(f"Running {len(rep_params)} jobs in total")
 print("\n\n\n\n")
 currtime = time.time()
 outs = Parallel(n_jobs=1, verbose=10)(
-    delayed(run_random_walks)(**p) for p in rep_params
+    delayed(run_random_walks)(prob_mat, **p) for p in rep_params
 )
 print(f"{time.time() - currtime} elapsed")
 
 # %% [markdown]
 # # Read paths from file
-base_loc = "maggot_models/notebooks/outs/98.0-BDP-path-semantics/csvs/"
 param_paths = []
 for p in params:
-    paths = []
-    filename = base_loc + basename + f"{p['sens_classes']}-{p['out_classes']}"
-    with open(f"{filename}.csv", "r") as f:
-        reader = csv.reader(f)
-        for line in reader:
-            paths.append([int(l) for l in line])
-    param_paths.append(paths)
+    name = basename + f"{p['sens_classes']}-{p['out_classes']}"
+    param_paths.append(readpaths(name, foldername=FNAME))
 
 # %% [markdown]
 # #
@@ -196,14 +188,13 @@ idx = meta.loc[4679139, "idx"]
 # %% [markdown]
 # # TEMP
 # examine where the neurons 'die'
-paths = param_paths[0]
+flat_paths, offsets = param_paths[0]
 out_inds = meta[meta[class_key].isin(out_groups[0])]["idx"].values
 # dead_counts = {i: 0 for i in range(n_verts)}
-dead_counts = np.zeros(n_verts)
-for path in paths:
-    if len(path) < 32:
-        if path[-1] not in out_inds:
-            dead_counts[path[-1]] += 1
+path_lens = np.diff(offsets)
+last_inds = flat_paths[offsets[1:] - 1]
+is_dead = (path_lens < 32) & ~np.isin(last_inds, out_inds)
+dead_counts = np.bincount(last_inds[is_dead], minlength=n_verts)
 
 dead_meta = meta.copy()
 dead_meta["dead_counts"] = dead_counts
@@ -273,7 +264,8 @@ stashcsv(dead_meta, "dead-neurons-03-05")
 #         return None
 
 
-# dead_inds = np.where(prob_mat.sum(axis=1) == 0)[0]
+# prob_mat, is_dead = to_markov_matrix(adj, return_dead=True)
+# dead_inds = np.flatnonzero(is_dead)
 # _simulate_walk(1, prob_mat, out_inds, dead_inds, max_walk)
 
 # # %% [markdown]
@@ -294,14 +286,7 @@ stashcsv(dead_meta, "dead-neurons-03-05")
 # print(f"{time.time() - currtime} elapsed")
 
 
-# def calculate_path_lengths(paths):
-#     lens = []
-#     for path in paths:
-#         lens.append(len(path))
-#     return lens
-
-
-# path_lens = calculate_path_lengths(paths)
+# path_lens = np.diff(offsets)
 
 # sns.distplot(path_lens)
 
@@ -333,15 +318,9 @@ stashcsv(dead_meta, "dead-neurons-03-05")
 # # # %% [markdown]
 # # # #
 
-# # meta["median_visit"] = -1
-# # meta["n_visits"] = 0
-
-# # visit_orders = path_to_visits(paths, n_verts)
-
-# # for node_ind, visits in visit_orders.items():
-# #     median_order = np.median(visits)
-# #     meta.iloc[node_ind, meta.columns.get_loc("median_visit")] = median_order
-# #     meta.iloc[node_ind, meta.columns.get_loc("n_visits")] = len(visits)
+# # median_visits, n_visits = path_to_median_visits(paths, n_verts)
+# # meta["median_visit"] = median_visits
+# # meta["n_visits"] = n_visits
 
 
 # %% [markdown]
@@ -349,18 +328,18 @@ stashcsv(dead_meta, "dead-neurons-03-05")
 
 node_encodings = {i: [] for i in range(n_verts)}
 for i, p in enumerate(params):
-    paths = param_paths[i]
-    out_inds = meta[meta[class_key].isin(p["out_classes"])]["idx"].values
-    from_visit_orders = path_to_visits(paths, n_verts, from_order=True)
-    for node, orders in from_visit_orders.items():
-        node_encodings[node].append(np.median(orders))
-    out_visit_orders = path_to_visits(
-        paths, n_verts, from_order=False, out_inds=out_inds
+    flat_paths, offsets = param_paths[i]
+    from_medians, visit_counts = path_to_median_visits(
+        flat_paths, n_verts, from_order=True, offsets=offsets
+    )
+    out_medians, _ = path_to_median_visits(
+        flat_paths, n_verts, from_order=False, offsets=offsets
     )
-    for node, orders in out_visit_orders.items():
-        node_encodings[node].append(np.median(orders))
+    for node in range(n_verts):
+        node_encodings[node].append(from_medians[node])
+        node_encodings[node].append(out_medians[node])
     fig, ax = plt.subplots(1, 1, figsize=(10, 5))
-    sns.distplot([len(visits) for visits in from_visit_orders.values()], ax=ax)
+    sns.distplot(visit_counts, ax=ax)
     ax.set_title(p)
 
 # %% [markdown]
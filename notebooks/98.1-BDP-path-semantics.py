@@ -127,7 +127,7 @@ ind_map = dict(zip(meta.index, meta["idx"]))
 inv_map = dict(zip(meta["idx"], meta.index))
 
 g = nx.relabel_nodes(g, ind_map, copy=True)
-prob_mat = to_markov_matrix(adj)
+prob_mat = to_markov_matrix(adj, dtype=np.float32)
 n_walks = 1000
 max_walk = 30
 
@@ -144,7 +144,7 @@ basename = (
 )
 
 
-def run_random_walks(sens_classes=None, out_classes=None, seed=None):
+def run_random_walks(prob_mat, sens_classes=None, out_classes=None, seed=None):
     np.random.seed(seed)
     from_inds = meta[meta[class_key].isin(sens_classes)]["idx"].values
     out_inds = meta[meta[class_key].isin(out_classes)]["idx"].values
@@ -181,8 +181,10 @@ print("\n\n\n\n")
 print(f"Running {len(rep_params)} jobs in total")
 print("\n\n\n\n")
 currtime = time.time()
+# pass prob_mat as an argument so that joblib memmaps it once for all of the
+# workers, rather than pickling it along with run_random_walks for each task
 outs = Parallel(n_jobs=-1, verbose=10)(
-    delayed(run_random_walks)(**p) for p in rep_params
+    delayed(run_random_walks)(prob_mat, **p) for p in rep_params
 )
 print(f"{time.time() - currtime} elapsed")
 
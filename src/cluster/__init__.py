@@ -1,4 +1,4 @@
-from .divisive import DivisiveCluster
+from .divisive import DivisiveCluster, FlatDivisiveTree
 from .spectral import (
     get_paired_inds,
     compute_pairedness_bipartite,
@@ -1,12 +1,34 @@
+import warnings
+
 import numpy as np
-from anytree import LevelOrderGroupIter, NodeMixin, PostOrderIter, RenderTree
+from anytree import LevelOrderGroupIter, NodeMixin, RenderTree
 from anytree.util import leftsibling
+from joblib import Parallel, delayed
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.utils import check_random_state
 
 from graspy.cluster import GaussianCluster, AutoGMMCluster
 
 valid_methods = ["graspy-gmm", "auto-gmm"]
 
 
+def _fit_gmm(X, random_state, max_iter=100, screen=False):
+    cluster = GaussianCluster(
+        min_components=1,
+        max_components=2,
+        n_init=1,
+        covariance_type="all",
+        max_iter=max_iter,
+        random_state=random_state,
+    )
+    if not screen:
+        return cluster.fit(X)
+    with warnings.catch_warnings():
+        # screening fits are stopped early on purpose
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        return cluster.fit(X)
+
+
 class DivisiveCluster(NodeMixin):
     def __init__(
         self,
@@ -16,6 +38,9 @@ class DivisiveCluster(NodeMixin):
         children=None,
         n_init=50,
         cluster_method="graspy-gmm",
+        n_jobs=1,
+        n_screen=None,
+        random_state=None,
     ):
         self.name = name
         self.parent = parent
@@ -26,34 +51,52 @@ class DivisiveCluster(NodeMixin):
         self.y_ = None
         self.n_init = n_init
         self.cluster_method = cluster_method
+        self.n_jobs = n_jobs
+        self.n_screen = n_screen
+        self.random_state = random_state
 
     def fit(self, X, y=None):
         n_samples = X.shape[0]
         self.n_samples_ = n_samples
         self.cum_dist_ = 0
+        rng = check_random_state(self.random_state)
         if n_samples > self.min_split_samples:
             if self.cluster_method == "graspy-gmm":
-                cluster = GaussianCluster(
-                    min_components=1,
-                    max_components=2,
-                    n_init=self.n_init,
-                    covariance_type="all",
+                # GaussianCluster runs its restarts serially, so run them in parallel
+                # here and keep the one with the best BIC
+                seeds = list(rng.randint(np.iinfo(np.int32).max, size=self.n_init))
+                if self.n_screen is not None and self.n_screen < self.n_init:
+                    # a few EM iterations are enough to rule out most restarts, so
+                    # only run the most promising ones to convergence
+                    screens = Parallel(n_jobs=self.n_jobs)(
+                        delayed(_fit_gmm)(X, seed, max_iter=5, screen=True)
+                        for seed in seeds
+                    )
+                    screen_bics = [screen.bic_.values.min() for screen in screens]
+                    best_inds = np.argsort(screen_bics)[: self.n_screen]
+                    seeds = [seeds[i] for i in best_inds]
+                restarts = Parallel(n_jobs=self.n_jobs)(
+                    delayed(_fit_gmm)(X, seed) for seed in seeds
                 )
+                cluster = min(restarts, key=lambda restart: restart.bic_.values.min())
+                # best BIC over restarts for each model, as GaussianCluster's n_init
+                bics = cluster.bic_.copy()
+                bics[:] = np.min([restart.bic_.values for restart in restarts], axis=0)
             elif self.cluster_method == "auto-gmm":
                 cluster = AutoGMMCluster(
                     min_components=1, max_components=2, max_agglom_size=None
                 )
+                cluster.fit(X)
+                bics = getattr(cluster, "bic_", None)
             elif self.cluster_method == "vmm":
                 # cluster = VonMisesFisherMixture(n)
                 pass
             else:
                 raise ValueError(f"`cluster_method` must be one of {valid_methods}")
-            cluster.fit(X)
             pred_labels = cluster.predict(X)
             self.pred_labels_ = pred_labels
             self.model_ = cluster
-            if hasattr(cluster, "bic_"):
-                bics = cluster.bic_
+            if bics is not None:
                 self.bics_ = bics
                 bic_ratio = bics.loc[2].min() / bics.loc[1].min()
                 self.bic_ratio_ = bic_ratio
@@ -68,10 +111,14 @@ class DivisiveCluster(NodeMixin):
                         min_split_samples=self.min_split_samples,
                         n_init=self.n_init,
                         cluster_method=self.cluster_method,
+                        n_jobs=self.n_jobs,
+                        n_screen=self.n_screen,
+                        random_state=rng.randint(np.iinfo(np.int32).max),
                     )
                     child = child.fit(X_child)
                     children.append(child)
                 self.children = children
+        self._n_leaves = sum(c._n_leaves for c in self.children) if self.children else 1
         return self
 
     def predict_sample(self, sample, label):
@@ -105,28 +152,11 @@ class DivisiveCluster(NodeMixin):
                 return self.children[1].predict_sample(sample, label)
 
     def predict(self, X, y=None):
-        if not self.children:
-            prediction = np.array(X.shape[0] * [self.name])
-            return prediction
-        else:
-            node_preds = self.model_.predict(X, y=None)
-            indicator = node_preds == 0
-            left_preds = self.children[0].predict(X[indicator, :])
-            right_preds = self.children[1].predict(X[~indicator, :])
-            # this is a hacky way of making sure arrays have sufficiently large string
-            # datatype to not lose information, without making any assumptions about
-            # number of splits ahead of time. Sure there is a better way.
-            if np.can_cast(left_preds.dtype, right_preds.dtype):
-                # everything in left can be safely cast to right
-                preds = np.zeros(X.shape[0], dtype=right_preds.dtype)
-            elif np.can_cast(right_preds.dtype, left_preds.dtype):
-                preds = np.zeros(X.shape[0], dtype=left_preds.dtype)
-            else:
-                print(left_preds.dtype, right_preds.dtype)
-                raise ValueError("Cannot cast strings to proper size")
-            preds[indicator] = left_preds
-            preds[~indicator] = right_preds
-        return preds
+        # one pass down the flattened tree, rather than recursing through the nodes
+        return self.flatten().predict(X)
+
+    def flatten(self):
+        return FlatDivisiveTree(self)
 
     def print_tree(self, print_val="n_samples"):
         for pre, _, node in RenderTree(self):
@@ -146,12 +176,9 @@ class DivisiveCluster(NodeMixin):
         for group in LevelOrderGroupIter(self):
             levels.append(group)
 
-        # just find how many nodes are leaves
-        # this is necessary only because we need to add n to non-leaf clusters
-        num_leaves = 0
-        for node in PostOrderIter(self):
-            if not node.children:
-                num_leaves += 1
+        # the leaf count is necessary only because we need to add n to non-leaf
+        # clusters. it is tallied during fit
+        num_leaves = self._n_leaves
 
         link_count = 0
         node_index = 0
@@ -208,3 +235,85 @@ class DivisiveCluster(NodeMixin):
         linkages = np.array(linkages, dtype=np.double)  # needs to be a double for scipy
         return (linkages, labels)
 
+
+class FlatDivisiveTree:
+    """A fitted DivisiveCluster stored as arrays in breadth first order, so that
+    predict and build_linkage iterate over arrays rather than chase node pointers.
+    Node 0 is the root, children of node i are at `children_left[i]` and
+    `children_right[i]`, and leaves have children of -1. Not a complete binary tree
+    layout (children at 2i + 1, 2i + 2), since divisive trees can be very unbalanced
+    """
+
+    def __init__(self, root):
+        nodes = [node for group in LevelOrderGroupIter(root) for node in group]
+        node_ids = {id(node): i for i, node in enumerate(nodes)}
+        n_nodes = len(nodes)
+        self.children_left = np.full(n_nodes, -1, dtype=np.int32)
+        self.children_right = np.full(n_nodes, -1, dtype=np.int32)
+        self.parents = np.full(n_nodes, -1, dtype=np.int32)
+        self.depths = np.zeros(n_nodes, dtype=np.int32)
+        for i, node in enumerate(nodes):
+            if node.children:
+                left, right = (node_ids[id(child)] for child in node.children)
+                self.children_left[i] = left
+                self.children_right[i] = right
+                self.parents[[left, right]] = i
+                self.depths[[left, right]] = self.depths[i] + 1
+        self.n_samples = np.array([node.n_samples_ for node in nodes], dtype=np.int32)
+        self.names = np.array([node.name for node in nodes])
+        self.models = [getattr(node, "model_", None) for node in nodes]
+
+    def predict(self, X):
+        """Leaf name for each sample"""
+        return self.names[self.predict_ids(X)]
+
+    def predict_ids(self, X):
+        """Index of the leaf node for each sample, so `names[ids]` are the labels.
+        Each internal node's model predicts once, on only the samples which reach
+        that node"""
+        ids = np.empty(X.shape[0], dtype=np.int32)
+        node_inds = {0: np.arange(X.shape[0])}
+        # in breadth first order, every parent is visited before its children
+        for i, (left, right) in enumerate(zip(self.children_left, self.children_right)):
+            inds = node_inds.pop(i)
+            if left == -1:
+                ids[inds] = i
+                continue
+            if len(inds) > 0:
+                indicator = self.models[i].predict(X[inds]) == 0
+            else:
+                indicator = np.zeros(0, dtype=bool)
+            node_inds[left] = inds[indicator]
+            node_inds[right] = inds[~indicator]
+        return ids
+
+    def build_linkage(self):
+        """Same linkage and labels as `DivisiveCluster.build_linkage`"""
+        is_leaf = self.children_left == -1
+        num_leaves = np.count_nonzero(is_leaf)
+        max_depth = self.depths.max()
+        inds = np.zeros(len(self.names), dtype=np.int64)
+        n_clusters = np.ones(len(self.names), dtype=np.int64)
+        node_index = 0
+        link_count = 0
+        linkages = []
+        labels = []
+        for depth in range(max_depth, 0, -1):
+            # siblings are adjacent within each level
+            level_nodes = np.flatnonzero(self.depths == depth)
+            for left, right in level_nodes.reshape(-1, 2):
+                for node in (left, right):
+                    if is_leaf[node]:
+                        inds[node] = node_index
+                        node_index += 1
+                        labels.append(self.names[node])
+                parent = self.parents[left]
+                n_clusters[parent] = n_clusters[left] + n_clusters[right]
+                inds[parent] = link_count + num_leaves
+                link_count += 1
+                distance = max_depth - depth + 1  # equal height for all links
+                linkages.append([inds[left], inds[right], distance, n_clusters[parent]])
+
+        labels = np.array(labels)
+        linkages = np.array(linkages, dtype=np.double)  # needs to be a double for scipy
+        return (linkages, labels)
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.sparse import diags, issparse
 from graspy.embed import AdjacencySpectralEmbed, LaplacianSpectralEmbed, OmnibusEmbed
 from graspy.utils import pass_to_ranks, get_lcc
 
@@ -24,7 +25,8 @@ def to_laplace(graph, form="DAD", regularizer=None):
     ----------
     graph: object
         Either array-like, (n_vertices, n_vertices) numpy array,
-        or an object of type networkx.Graph.
+        or an object of type networkx.Graph. A scipy sparse matrix gives a sparse
+        laplacian.
     form: {'I-DAD' (default), 'DAD', 'R-DAD'}, string, optional
         
         - 'I-DAD'
@@ -54,8 +56,12 @@ def to_laplace(graph, form="DAD", regularizer=None):
 
     A = graph
 
-    in_degree = np.sum(A, axis=0)
-    out_degree = np.sum(A, axis=1)
+    if issparse(A):
+        in_degree = np.asarray(A.sum(axis=0), dtype=float).ravel()
+        out_degree = np.asarray(A.sum(axis=1), dtype=float).ravel()
+    else:
+        in_degree = np.sum(A, axis=0)
+        out_degree = np.sum(A, axis=1)
 
     # regularize laplacian with parameter
     # set to average degree
@@ -80,14 +86,20 @@ def to_laplace(graph, form="DAD", regularizer=None):
     in_root[np.isinf(in_root)] = 0
     out_root[np.isinf(out_root)] = 0
 
-    in_root = np.diag(in_root)  # just change to sparse diag for sparse support
-    out_root = np.diag(out_root)
-
     if form == "I-DAD":
-        L = np.diag(in_degree) - A
-        L = in_root @ L @ in_root
+        L = (diags if issparse(A) else np.diag)(in_degree) - A
+        row_root, col_root = in_root, in_root
     elif form == "DAD" or form == "R-DAD":
-        L = out_root @ A @ in_root
+        L = A
+        row_root, col_root = out_root, in_root
+
+    if issparse(L):
+        L = diags(row_root) @ L @ diags(col_root)
+    else:
+        # scale rows and columns by broadcasting into one new array, rather than
+        # multiplying by two dense n x n diagonal matrices
+        L = L * col_root[np.newaxis, :]
+        L *= row_root[:, np.newaxis]
     # return symmetrize(L, method="avg")  # sometimes machine prec. makes this necessary
     return L
 
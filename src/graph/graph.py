@@ -1,7 +1,9 @@
 import networkx as nx
 import numpy as np
 import pandas as pd
-from graspy.utils import is_almost_symmetric, get_lcc
+from graspy.utils import is_almost_symmetric
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from pathlib import Path
 from operator import itemgetter
 from copy import deepcopy
@@ -107,8 +109,13 @@ class MetaGraph:
         return self
 
     def make_lcc(self):
-        lcc, inds = get_lcc(self.adj, return_inds=True)
-        self.adj = lcc
+        # weakly connected components straight from the sparse adjacency, which
+        # avoids graspy's get_lcc round trip through networkx
+        _, labels = connected_components(
+            csr_matrix(self.adj), directed=True, connection="weak"
+        )
+        inds = np.flatnonzero(labels == np.bincount(labels).argmax())
+        self.adj = self.adj[np.ix_(inds, inds)]
         self.meta = self.meta.iloc[inds, :]
         self.g = _numpy_pandas_to_nx(self.adj, self.meta)
         self.n_verts = self.adj.shape[0]
@@ -1,5 +1,21 @@
 import numpy as np
 from graspy.utils import remove_loops
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def _signal_flow_b(A):
+    """Row sums of W * sign(A - A.T), with W = (A + A.T) / 2, in one pass over A"""
+    n = A.shape[0]
+    b = np.zeros(n)
+    for i in prange(n):
+        total = 0.0
+        for j in range(n):
+            diff = A[i, j] - A[j, i]
+            if diff != 0:
+                total += (A[i, j] + A[j, i]) / 2 * np.sign(diff)
+        b[i] = total
+    return b
 
 
 def signal_flow(A):
@@ -19,11 +35,10 @@ def signal_flow(A):
     A = remove_loops(A)
     W = (A + A.T) / 2
 
-    D = np.diag(np.sum(W, axis=1))
-
-    L = D - W
+    L = -W
+    L[np.diag_indices_from(L)] += np.sum(W, axis=1)
 
-    b = np.sum(W * np.sign(A - A.T), axis=1)
+    b = _signal_flow_b(np.asarray(A, dtype=np.float64))
     L_pinv = np.linalg.pinv(L)
     z = L_pinv @ b
 
@@ -33,19 +48,20 @@ def signal_flow(A):
 def normalized_laplacian(A, n_components=5, return_evals=False, normalize_evecs=True):
     W = (A + A.T) / 2
 
-    D = np.diag(np.sum(W, axis=1))
+    d = np.sum(W, axis=1)
 
-    L = D - W
-    D_root = np.diag(np.diag(D) ** (-1 / 2))
-    D_root[np.isnan(D_root)] = 0
-    D_root[np.isinf(D_root)] = 0
-    Q = D_root @ L @ D_root
+    L = -W
+    L[np.diag_indices_from(L)] += d
+    with np.errstate(divide="ignore"):
+        d_root = d ** (-1 / 2)
+    d_root[np.isinf(d_root)] = 0
+    Q = L * d_root[:, np.newaxis] * d_root[np.newaxis, :]
     evals, evecs = np.linalg.eig(Q)
     inds = np.argsort(evals)
     evals = evals[inds]
     evecs = evecs[:, inds]
     if normalize_evecs:
-        evecs = np.diag(np.diag(D) ** (-1 / 2)) @ evecs
+        evecs = evecs * d_root[:, np.newaxis]
     # print(evecs[:, 0])
     if return_evals:
         return evecs[:, :n_components], evals[:n_components]
@@ -1 +1,2 @@
 from .io import savefig, saveobj, saveskels, savecsv, savelol, readlol, readcsv
+from .io import savepaths, readpaths
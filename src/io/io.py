@@ -191,6 +191,34 @@ def readlol(
     return outer_list
 
 
+def savepaths(
+    flat_paths,
+    offsets,
+    name,
+    foldername=None,
+    subfoldername="objs",
+    pathname="./maggot_models/notebooks/outs",
+    save_on=True,
+):
+    if save_on:
+        path = _handle_dirs(pathname, foldername, subfoldername)
+        savename = path / str(name + ".npz")
+        np.savez_compressed(savename, flat_paths=flat_paths, offsets=offsets)
+        print(f"Saved paths to {savename}")
+
+
+def readpaths(
+    name,
+    foldername=None,
+    subfoldername="objs",
+    pathname="./maggot_models/notebooks/outs",
+):
+    path = _handle_dirs(pathname, foldername, subfoldername)
+    savename = path / str(name + ".npz")
+    with np.load(savename) as f:
+        return f["flat_paths"], f["offsets"]
+
+
 def readcsv(
     name,
     foldername=None,
@@ -1,4 +1,9 @@
-from .random_walk import generate_random_walks, to_markov_matrix, RandomWalk
+from .random_walk import (
+    generate_random_walks,
+    generate_random_walks_flat,
+    to_markov_matrix,
+    RandomWalk,
+)
 from .cascade import (
     generate_cascade_paths,
     generate_cascade_tree,
@@ -7,6 +12,7 @@ from .cascade import (
     to_transmission_matrix,
 )
 from .traverse import (
+    path_to_median_visits,
     path_to_visits,
     to_path_graph,
     collapse_multigraph,
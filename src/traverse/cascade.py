@@ -43,11 +43,11 @@ class Cascade(BaseTraverse):
             super().start(start_node)
 
     def _check_visited(self):
-        self._active = np.setdiff1d(self._active, self._visited)
+        self._active = np.unique(self._active[~self._visited[self._active]])
         return len(self._active) > 0
 
     def _check_stop_nodes(self):
-        self._active = np.setdiff1d(self._active, self.stop_nodes)
+        self._active = np.unique(self._active[~self._stop_mask[self._active]])
         return len(self._active) > 0
 
 
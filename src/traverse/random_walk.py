@@ -1,20 +1,85 @@
 import numpy as np
-from .traverse import BaseTraverse
+from numba import njit, prange
+from scipy.sparse import csr_matrix, diags, issparse
+from .traverse import BaseTraverse, path_to_median_visits
 
 
 class RandomWalk(BaseTraverse):
+    def __init__(self, transition_probs, *args, **kwargs):
+        super().__init__(transition_probs, *args, **kwargs)
+        # alias tables over each row's nonzeros, so each step is O(1)
+        prob_csr = csr_matrix(transition_probs)
+        prob_csr.eliminate_zeros()
+        self._indptr = prob_csr.indptr
+        self._indices = prob_csr.indices
+        self._alias_probs, self._aliases = _alias_tables(
+            prob_csr.indptr, prob_csr.data
+        )
+        # rows which aren't distributions stop the walk
+        row_sums = np.asarray(prob_csr.sum(axis=1)).ravel()
+        self._is_distribution = np.isclose(row_sums, 1)
+
     def _choose_next(self):
-        node_transition_probs = self.transition_probs[self._active]
-        if np.isclose(np.sum(node_transition_probs), 1):
-            nxt = np.random.choice(self.n_verts, p=node_transition_probs)
-            return nxt
+        node = self._active
+        if self._is_distribution[node]:
+            start = self._indptr[node]
+            j = start + np.random.randint(self._indptr[node + 1] - start)
+            if np.random.random() >= self._alias_probs[j]:
+                j = start + self._aliases[j]
+            return self._indices[j]
+
+    def _choose_next_batch(self, nodes):
+        starts = self._indptr[nodes]
+        degs = self._indptr[nodes + 1] - starts
+        cols = (np.random.random(len(nodes)) * degs).astype(np.int64)
+        j = starts + np.minimum(cols, degs - 1)
+        flip = np.random.random(len(nodes)) >= self._alias_probs[j]
+        j[flip] = starts[flip] + self._aliases[j[flip]]
+        return self._indices[j]
 
+    def start_batch(self, start_node, n_walks):
+        """Runs `n_walks` walks from `start_node` in lockstep, taking one vectorized
+        step for all of the walks still going. Returns the same hop histogram that
+        `TraverseDispatcher.start` tallies from `n_walks` calls to `start`"""
+        hit_hist = np.zeros((self.n_verts, self.max_hops))
+        walk_inds = np.arange(n_walks)
+        active = np.full(n_walks, start_node, dtype=np.int64)
+        if not self.allow_loops:
+            visited = np.zeros((n_walks, self.n_verts), dtype=bool)
+        for hop in range(self.max_hops):
+            hit_hist[:, hop] += np.bincount(active, minlength=self.n_verts)
+            if not self.allow_loops:
+                visited[walk_inds, active] = True
+            # walks end on stop nodes, and on rows which aren't distributions
+            going = ~self._stop_mask[active] & self._is_distribution[active]
+            if hop == self.max_hops - 1 or not going.any():
+                break
+            walk_inds = walk_inds[going]
+            active = self._choose_next_batch(active[going])
+            if not self.allow_loops:
+                going = ~visited[walk_inds, active]
+                walk_inds = walk_inds[going]
+                active = active[going]
+        return hit_hist
 
-def to_markov_matrix(adj):
-    prob_mat = adj.copy()
-    row_sums = prob_mat.sum(axis=1)
-    row_sums[row_sums == 0] = 1  # plug the holes
-    prob_mat = prob_mat / row_sums[:, np.newaxis]
+
+def to_markov_matrix(adj, return_dead=False, dtype=np.float64):
+    """Row normalizes `adj`. If `return_dead`, also returns a mask of the rows with
+    no outgoing weight, taken from the row sums computed here anyway. float32 is
+    plenty for sampling walks, and halves the memory of the matrix"""
+    if issparse(adj):
+        row_sums = np.asarray(adj.sum(axis=1), dtype=float).ravel()
+    else:
+        row_sums = adj.sum(axis=1)
+    is_dead = row_sums == 0
+    row_sums[is_dead] = 1  # plug the holes
+    if issparse(adj):
+        prob_mat = csr_matrix(diags(1 / row_sums) @ adj)
+    else:
+        prob_mat = adj / row_sums[:, np.newaxis]
+    prob_mat = prob_mat.astype(dtype, copy=False)
+    if return_dead:
+        return prob_mat, is_dead
     return prob_mat
 
 
@@ -31,44 +96,180 @@ def random_walks_from_node(
     pass
 
 
+@njit(cache=True)
+def _alias_tables(indptr, probs):
+    """Walker alias tables for each row of a CSR matrix of transition probabilities,
+    over that row's nonzeros only. Aliases are offsets within the row. Tables are
+    built in float64 but stored as float32, which is plenty for sampling"""
+    alias_probs = np.ones(len(probs), dtype=np.float32)
+    aliases = np.zeros(len(probs), dtype=np.int32)
+    for i in range(len(indptr) - 1):
+        start = indptr[i]
+        deg = indptr[i + 1] - start
+        if deg == 0:
+            continue
+        row = probs[start : start + deg].astype(np.float64)
+        scaled = row * deg / row.sum()
+        small = np.empty(deg, dtype=np.int64)
+        large = np.empty(deg, dtype=np.int64)
+        n_small = 0
+        n_large = 0
+        for j in range(deg):
+            aliases[start + j] = j
+            if scaled[j] < 1:
+                small[n_small] = j
+                n_small += 1
+            else:
+                large[n_large] = j
+                n_large += 1
+        while n_small > 0 and n_large > 0:
+            n_small -= 1
+            s = small[n_small]
+            l = large[n_large - 1]
+            alias_probs[start + s] = scaled[s]
+            aliases[start + s] = l
+            scaled[l] += scaled[s] - 1
+            if scaled[l] < 1:
+                n_large -= 1
+                small[n_small] = l
+                n_small += 1
+    return alias_probs, aliases
+
+
+_PCG_MULT = np.uint64(6364136223846793005)
+_PCG_INC = np.uint64(1442695040888963407)
+_MASK_32 = np.uint64(0xFFFFFFFF)
+
+
+@njit(cache=True)
+def _pcg32(state):
+    """Advances a PCG32 (XSH RR) generator, returning the new state and 32 random
+    bits. Its state is one uint64, so unlike np.random.seed, seeding each walk costs
+    nothing"""
+    new_state = state * _PCG_MULT + _PCG_INC
+    xorshifted = (((state >> np.uint64(18)) ^ state) >> np.uint64(27)) & _MASK_32
+    rot = state >> np.uint64(59)
+    left = (xorshifted << ((np.uint64(32) - rot) & np.uint64(31))) & _MASK_32
+    return new_state, (xorshifted >> rot) | left
+
+
+@njit(parallel=True, cache=True)
+def _simulate_walks(
+    starts, indptr, indices, alias_probs, aliases, is_out, max_walk, seeds
+):
+    """One random walk per entry in `starts`, stepping in O(1) with the per-row alias
+    tables. Returns the paths padded with -1, and their lengths"""
+    n_walks = len(starts)
+    paths = np.full((n_walks, max_walk + 2), -1, dtype=np.int32)
+    path_lens = np.zeros(n_walks, dtype=np.int64)
+    for w in prange(n_walks):
+        # seeded per walk, so results don't depend on how walks land on threads
+        state, _ = _pcg32(np.uint64(seeds[w]) + _PCG_INC)
+        curr_ind = starts[w]
+        paths[w, 0] = curr_ind
+        n_steps = 0
+        while not is_out[curr_ind] and n_steps <= max_walk:
+            start = indptr[curr_ind]
+            deg = indptr[curr_ind + 1] - start
+            if deg == 0:  # dead end
+                break
+            state, bits = _pcg32(state)
+            j = start + np.int64((bits * np.uint64(deg)) >> np.uint64(32))  # [0, deg)
+            state, bits = _pcg32(state)
+            if bits * 2.0 ** -32 >= alias_probs[j]:
+                j = start + aliases[j]
+            curr_ind = indices[j]
+            n_steps += 1
+            paths[w, n_steps] = curr_ind
+        path_lens[w] = n_steps + 1
+    return paths, path_lens
+
+
+def _walk_paths(prob_mat, from_inds, out_inds, n_walks, max_walk, return_stuck):
+    """Padded paths and lengths for all walks, and a mask of the walks to keep"""
+    prob_csr = csr_matrix(prob_mat)
+    prob_csr.eliminate_zeros()
+    n_verts = prob_csr.shape[0]
+    is_dead = np.diff(prob_csr.indptr) == 0
+    is_out = np.zeros(n_verts, dtype=bool)
+    is_out[out_inds] = True
+    alias_probs, aliases = _alias_tables(prob_csr.indptr, prob_csr.data)
+    starts = np.repeat(np.asarray(from_inds, dtype=np.int64), n_walks)
+    # drawn from numpy's global state, so np.random.seed still controls the walks
+    seeds = np.random.randint(np.iinfo(np.int32).max, size=len(starts))
+    paths, path_lens = _simulate_walks(
+        starts,
+        prob_csr.indptr,
+        prob_csr.indices,
+        alias_probs,
+        aliases,
+        is_out,
+        max_walk,
+        seeds,
+    )
+
+    last_inds = paths[np.arange(len(paths)), path_lens - 1]
+    reached_out = is_out[last_inds]
+    stuck = ~reached_out & is_dead[last_inds]
+    too_long = ~reached_out & ~stuck & (path_lens - 1 > max_walk)
+    other = ~reached_out & ~stuck & ~too_long
+    stop_reasons = np.array([m.sum() for m in [reached_out, stuck, too_long, other]])
+    keep = reached_out | (stuck & return_stuck)
+
+    print(stop_reasons / stop_reasons.sum())
+    print(keep.sum())
+    return paths, path_lens, keep
+
+
+def _flatten_paths(paths, path_lens):
+    flat_paths = paths[np.arange(paths.shape[1]) < path_lens[:, np.newaxis]]
+    offsets = np.concatenate(([0], np.cumsum(path_lens)))
+    return flat_paths, offsets
+
+
+def generate_random_walks_flat(
+    prob_mat,
+    from_inds,
+    out_inds,
+    n_walks=100,
+    max_walk=25,
+    return_stuck=False,
+    return_visits=False,
+):
+    """Same walks as `generate_random_walks`, but the kept paths are concatenated
+    into one int32 array, where path i is `flat_paths[offsets[i]:offsets[i + 1]]`.
+    If `return_visits`, also returns the median visit order and number of visits of
+    each node over all of the walks, kept or not, in place of the visit order dict"""
+    paths, path_lens, keep = _walk_paths(
+        prob_mat, from_inds, out_inds, n_walks, max_walk, return_stuck
+    )
+    flat_paths, offsets = _flatten_paths(paths[keep], path_lens[keep])
+    if not return_visits:
+        return flat_paths, offsets
+    all_flat_paths, all_offsets = _flatten_paths(paths, path_lens)
+    visit_medians, visit_counts = path_to_median_visits(
+        all_flat_paths, prob_mat.shape[0], offsets=all_offsets
+    )
+    return flat_paths, offsets, visit_medians, visit_counts
+
+
 def generate_random_walks(
     prob_mat, from_inds, out_inds, n_walks=100, max_walk=25, return_stuck=False
 ):
-    n_verts = len(prob_mat)
-    dead_inds = np.where(prob_mat.sum(axis=1) == 0)[0]
-    stop_reasons = np.zeros(4)
-    sm_paths = []
-    visit_orders = {i: [] for i in range(n_verts)}
-    for s in from_inds:
-        for n in range(n_walks):
-            curr_ind = s
-            n_steps = 0
-            path = [s]
-            visit_orders[s].append(len(path))
-            while (
-                (curr_ind not in out_inds)
-                and (n_steps <= max_walk)
-                and (curr_ind not in dead_inds)
-            ):
-                next_ind = np.random.choice(n_verts, p=prob_mat[curr_ind])
-                n_steps += 1
-                curr_ind = next_ind
-                path.append(curr_ind)
-                visit_orders[curr_ind].append(len(path))
-            if curr_ind in out_inds:
-                stop_reasons[0] += 1
-                sm_paths.append(path)
-            elif curr_ind in dead_inds:
-                stop_reasons[1] += 1
-                if return_stuck:
-                    sm_paths.append(path)
-            elif n_steps > max_walk:
-                stop_reasons[2] += 1
-            else:
-                stop_reasons[3] += 1
+    paths, path_lens, keep = _walk_paths(
+        prob_mat, from_inds, out_inds, n_walks, max_walk, return_stuck
+    )
+    n_verts = prob_mat.shape[0]
 
-    print(stop_reasons / stop_reasons.sum())
-    print(len(sm_paths))
+    # visit orders over all of the walks, kept or not, grouped by node
+    valid = np.arange(paths.shape[1]) < path_lens[:, np.newaxis]
+    nodes = paths[valid]
+    orders = np.broadcast_to(np.arange(1, paths.shape[1] + 1), paths.shape)[valid]
+    orders = orders[np.argsort(nodes, kind="stable")]
+    splits = np.cumsum(np.bincount(nodes, minlength=n_verts))[:-1]
+    visit_orders = dict(enumerate(o.tolist() for o in np.split(orders, splits)))
+
+    sm_paths = [path[:n].tolist() for path, n in zip(paths[keep], path_lens[keep])]
     return sm_paths, visit_orders
 
 
@@ -4,15 +4,54 @@ import networkx as nx
 from tqdm import tqdm
 
 
+def _visit_orders(nodes, path_lens, from_order=True):
+    """Order of each visit within its path, for concatenated paths"""
+    path_starts = np.repeat(np.cumsum(path_lens) - path_lens, path_lens)
+    orders = np.arange(len(nodes)) - path_starts  # position within the path
+    if from_order:
+        orders = orders + 1
+    else:
+        orders = np.repeat(path_lens, path_lens) - orders
+    return orders.astype(np.int32)
+
+
 def path_to_visits(paths, n_verts, from_order=True, out_inds=[]):
-    visit_orders = {i: [] for i in range(n_verts)}
-    for path in paths:
-        for i, n in enumerate(path):
-            if from_order:
-                visit_orders[n].append(i + 1)
-            else:
-                visit_orders[n].append(len(path) - i)
-    return visit_orders
+    path_lens = np.array([len(path) for path in paths], dtype=np.int64)
+    nodes = np.fromiter(
+        itertools.chain.from_iterable(paths), dtype=np.int64, count=path_lens.sum()
+    )
+    orders = _visit_orders(nodes, path_lens, from_order=from_order)
+    # group by node, stable so each node's visits stay in path order
+    orders = orders[np.argsort(nodes, kind="stable")]
+    splits = np.cumsum(np.bincount(nodes, minlength=n_verts))[:-1]
+    return dict(enumerate(o.tolist() for o in np.split(orders, splits)))
+
+
+def path_to_median_visits(paths, n_verts, from_order=True, offsets=None):
+    """Median visit order and number of visits for each node, as from
+    `path_to_visits`, but tallied in flat int32 arrays rather than per node lists.
+    Nodes which are never visited get a median of NaN. If `offsets` is given,
+    `paths` is one flat array of concatenated paths, as from
+    `generate_random_walks_flat`"""
+    if offsets is None:
+        path_lens = np.array([len(path) for path in paths], dtype=np.int64)
+        nodes = np.concatenate([np.asarray(path, dtype=np.int32) for path in paths])
+    else:
+        path_lens = np.diff(offsets)
+        nodes = np.asarray(paths)
+    orders = _visit_orders(nodes, path_lens, from_order=from_order)
+
+    # visits grouped by node, sorted by order within each node
+    sort_inds = np.lexsort((orders, nodes))
+    orders = orders[sort_inds]
+    counts = np.bincount(nodes, minlength=n_verts)
+    node_starts = np.cumsum(counts) - counts
+    visited = counts > 0
+    lower = orders[(node_starts + (counts - 1) // 2)[visited]]
+    upper = orders[(node_starts + counts // 2)[visited]]
+    medians = np.full(n_verts, np.nan)
+    medians[visited] = (lower + upper) / 2
+    return medians, counts
 
 
 def to_path_graph(paths):
@@ -60,6 +99,10 @@ class TraverseDispatcher:
 
     def start(self, start_node):
         worker = self._worker
+        if hasattr(worker, "start_batch"):
+            # all of the inits at once, rather than one traversal at a time
+            self.hit_hist_ = worker.start_batch(start_node, self.n_init)
+            return self.hit_hist_
         hit_hist = np.zeros((worker.n_verts, worker.max_hops))
         for i in tqdm(range(self.n_init)):
             worker.start(start_node)
@@ -115,6 +158,9 @@ class BaseTraverse:
         self.stop_nodes = stop_nodes
         self.allow_loops = allow_loops
         self.n_verts = len(transition_probs)
+        # membership tests against stop nodes are made every step, so keep a mask
+        self._stop_mask = np.zeros(self.n_verts, dtype=bool)
+        self._stop_mask[np.asarray(stop_nodes, dtype=int)] = True
         if record_traversal:
             self.traversal_ = None
         if not allow_loops:
@@ -124,11 +170,11 @@ class BaseTraverse:
         return not self._hop >= self.max_hops  # do not continue if greater than
 
     def _check_stop_nodes(self):
-        return self._active not in self.stop_nodes
+        return not self._stop_mask[self._active]
 
     def _check_visited(self):
         if not self.allow_loops:
-            return self._active not in self._visited
+            return not self._visited[self._active]
         else:
             return True
 
@@ -139,7 +185,7 @@ class BaseTraverse:
     def _reset(self):
         self._hop = 0
         self._active = None
-        self._visited = np.array([])
+        self._visited = np.zeros(self.n_verts, dtype=bool)
         if self.record_traversal:
             self.traversal_ = []
 
@@ -161,9 +207,7 @@ class BaseTraverse:
             self._hop += 1
             self.traversal_.append(nxt)
             if not self.allow_loops:
-                # May be slow? working with set() seemed overly complicated here,
-                # looked like I had to convert set to array for every comparison
-                self._visited = np.union1d(self._visited, nxt)
+                self._visited[nxt] = True
             return True
         else:
             return False
@@ -1,3 +1,5 @@
+from functools import partial
+
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
@@ -5,34 +7,86 @@ import seaborn as sns
 from src.visualization import gridmap, remove_spines
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 from matplotlib.colors import ListedColormap
+from numba import njit
+
+
+def _factorize(values):
+    """Integer codes which sort in the same order as `values`, in the narrowest dtype
+    that fits. Missing values get the last code, `n_uniques`"""
+    codes, uniques = pd.factorize(values, sort=True)
+    codes[codes == -1] = len(uniques)  # missing values last, as sort_values
+    return codes.astype(np.min_scalar_type(len(uniques)), copy=False), len(uniques)
 
 
 def sort_meta(length, meta, sort_class, sort_item=None, class_order="size"):
     if meta is None or len(meta) == 0:
         return np.arange(length), meta
-    meta = meta.copy()
+    if len(sort_class) == 0 and not sort_item:  # nothing to sort by
+        return np.arange(length), meta
+    # columns to add to the sorted meta, kept as arrays so meta is only copied once
+    sort_cols = {}
+    # each class is factorized once, for both the class statistics and the sort
+    sort_codes = {}
     total_sort_by = []
     for sc in sort_class:
+        codes, n_classes = _factorize(meta[sc])
+        sort_codes[sc] = codes
         if class_order == "size":
-            class_size = meta.groupby(sc).size()
+            class_size = np.bincount(codes)[codes].astype(float)
+            class_size[codes == n_classes] = np.nan
             # negative so we can sort alphabetical still in one line
-            meta[f"{sc}_size"] = -meta[sc].map(class_size)
+            sort_cols[f"{sc}_size"] = -class_size
             total_sort_by.append(f"{sc}_size")
         elif len(class_order) > 0:
             for co in class_order:
-                class_value = meta.groupby(sc)[co].mean()
-                meta[f"{sc}_{co}_order"] = meta[sc].map(class_value)
+                values = meta[co].to_numpy(dtype=float)
+                valid = ~np.isnan(values)
+                sums = np.bincount(
+                    codes[valid], weights=values[valid], minlength=n_classes + 1
+                )
+                counts = np.bincount(codes[valid], minlength=n_classes + 1)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    class_value = sums / counts
+                class_value[n_classes] = np.nan
+                sort_cols[f"{sc}_{co}_order"] = class_value[codes]
                 total_sort_by.append(f"{sc}_{co}_order")
         total_sort_by.append(sc)
     total_sort_by += sort_item
-    meta["sort_idx"] = range(len(meta))
+    sort_cols["sort_idx"] = np.arange(len(meta))
+    perm_inds = sort_cols["sort_idx"]
     if len(total_sort_by) > 0:
-        meta.sort_values(total_sort_by, inplace=True, kind="mergesort")
-    perm_inds = meta["sort_idx"].values
+        # np.lexsort is stable like mergesort, and takes the last key as primary
+        keys = []
+        for col in reversed(total_sort_by):
+            if col in sort_codes:
+                keys.append(sort_codes[col])
+            else:
+                values = sort_cols[col] if col in sort_cols else meta[col]
+                keys.append(_factorize(values)[0])
+        perm_inds = np.lexsort(keys)
+    meta = meta.take(perm_inds)
+    for col, values in sort_cols.items():
+        meta[col] = values[perm_inds]
     return perm_inds, meta
 
 
+def _cached_sort_meta(sort_cache, length, meta, sort_class, sort_item, class_order):
+    """`sort_meta`, remembering the result in the caller's `sort_cache` dict. Only
+    valid as long as the sorting columns of `meta` are not changed in place"""
+    class_order_key = class_order
+    if not isinstance(class_order, str):
+        class_order_key = tuple(class_order)
+    key = (id(meta), tuple(sort_class), tuple(sort_item), class_order_key)
+    # the entry holds on to meta, so its id can't be reused by another frame
+    if key in sort_cache and sort_cache[key][0] is meta:
+        return sort_cache[key][1]
+    sort_out = sort_meta(length, meta, sort_class, sort_item, class_order)
+    sort_cache[key] = (meta, sort_out)
+    return sort_out
+
+
 def remove_shared_ax(ax):
     shax = ax.get_shared_x_axes()
     shay = ax.get_shared_y_axes()
@@ -52,7 +106,9 @@ def remove_shared_ax(ax):
 
 def get_colors(labels, palette, desat=0.7):
     if isinstance(palette, dict):
-        colors = np.vectorize(palette.get)(labels)
+        # look up each unique label once, then index by the inverse
+        uni_labels, inv = np.unique(labels, return_inverse=True)
+        colors = np.array([palette.get(label) for label in uni_labels])[inv]
         return colors
     elif isinstance(palette, str):
         uni_labels = np.unique(labels)
@@ -60,9 +116,37 @@ def get_colors(labels, palette, desat=0.7):
         return get_colors(labels, dict(zip(uni_labels, palette)))
 
 
+def _class_colormap(classes, palette="tab10"):
+    """Integer code of each element of `classes`, and a colormap with one color per
+    code"""
+    # map each class to an integer to use to make the color heatmap
+    uni_classes, first_inds, class_indicator = np.unique(
+        classes, return_index=True, return_inverse=True
+    )
+    indicator_dtype = np.min_scalar_type(len(uni_classes))  # uint8 for < 256
+    class_indicator = class_indicator.astype(indicator_dtype, copy=False)
+    # make colormap
+    if isinstance(palette, dict):
+        color_sorted = np.array([palette.get(c) for c in uni_classes])
+    elif isinstance(palette, str):
+        # palette colors go to the classes in order of appearance
+        appear_rank = np.argsort(np.argsort(first_inds))
+        color_sorted = np.array(sns.color_palette(palette, len(uni_classes)))
+        color_sorted = color_sorted[appear_rank]
+    return class_indicator, ListedColormap(color_sorted)
+
+
 def draw_colors(
-    ax, divider=None, ax_type="x", colors=None, palette="tab10", sort_meta=None
+    ax,
+    divider=None,
+    ax_type="x",
+    colors=None,
+    palette="tab10",
+    sort_meta=None,
+    class_colormap=None,
 ):
+    """`class_colormap` is the output of `_class_colormap`, if it has already been
+    computed for these colors"""
     if len(colors) > 0:
         if ax_type == "x":
             cax = divider.append_axes("top", size="3%", pad=0, sharex=ax)
@@ -73,54 +157,67 @@ def draw_colors(
             colors[0]
         ]  # TODO eventually could allow for multiple sets of colors
 
-        if isinstance(palette, dict):
-            color_dict = palette
-        elif isinstance(palette, str):
-            color_dict = dict(
-                zip(classes.unique(), sns.color_palette(palette, classes.nunique()))
-            )
-        # make colormap
-        uni_classes = np.unique(classes)
-        class_map = dict(zip(uni_classes, range(len(uni_classes))))
-        color_sorted = np.vectorize(color_dict.get)(uni_classes)
-        # HACK fix the below 3 lines
-        # matrix is flipped when using color palette sometimes
-        color_sorted = np.array(color_sorted)
-        if len(color_sorted) != len(uni_classes):
-            color_sorted = color_sorted.T
-        lc = ListedColormap(color_sorted)
-        # map each class to an integer to use to make the color heatmap
-        class_indicator = np.vectorize(class_map.get)(classes)
+        if class_colormap is None:
+            class_colormap = _class_colormap(classes, palette)
+        class_indicator, lc = class_colormap
 
+        # cells span [i, i + 1] in data coordinates, like the heatmap cells
         if ax_type == "x":
             class_indicator = class_indicator.reshape(1, len(classes))
+            extent = (0, len(classes), 1, 0)
         elif ax_type == "y":
             class_indicator = class_indicator.reshape(len(classes), 1)
-        sns.heatmap(
+            extent = (0, 1, len(classes), 0)
+        cax.imshow(
             class_indicator,
             cmap=lc,
-            cbar=False,
-            yticklabels=False,
-            xticklabels=False,
-            ax=cax,
-            square=False,
+            aspect="auto",
+            interpolation="nearest",
+            extent=extent,
         )
+        cax.set_xticks([])
+        cax.set_yticks([])
+        remove_spines(cax)
         return cax
     else:
         return ax
 
 
+@njit(cache=True)
+def _scan_blocks(codes):
+    """Rows of `codes` where any column differs from the row above, and row 0"""
+    n_rows, n_cols = codes.shape
+    starts = np.zeros(max(n_rows, 1), dtype=np.int64)
+    n_starts = 1
+    for i in range(1, n_rows):
+        for j in range(n_cols):
+            if codes[i, j] != codes[i - 1, j]:
+                starts[n_starts] = i
+                n_starts += 1
+                break
+    return starts[:n_starts]
+
+
+def _block_bounds(sort_meta, sort_class):
+    """ Assumes meta is already sorted, so each class is one contiguous block. Returns
+    the start and end index of each block, and the first sort class of each block
+    """
+    # integer codes for each sort class, where missing values all share -1
+    codes = np.empty((len(sort_meta), len(sort_class)), dtype=np.int64)
+    for j, sc in enumerate(sort_class):
+        codes[:, j] = pd.factorize(sort_meta[sc])[0]
+    starts = _scan_blocks(codes)
+    ends = np.append(starts[1:], len(sort_meta))
+    return starts, ends, sort_meta[sort_class[0]].to_numpy()[starts]
+
+
 def _get_separator_info(sort_meta, sort_class):
     """ Assumes meta is already sorted
     """
     if sort_meta is None and sort_class is None:
         return None
-    # sort_meta[sort_class].fillna("", inplace=True)
-    sort_meta["sort_idx"] = range(len(sort_meta))
-    first_df = sort_meta.groupby(sort_class, sort=False).first()
-    sep_inds = list(first_df["sort_idx"].values)
-    last_df = sort_meta.groupby(sort_class, sort=False).last()
-    sep_inds.append(last_df["sort_idx"].values[-1] + 1)
+    starts, ends, _ = _block_bounds(sort_meta, sort_class)
+    sep_inds = np.append(starts, ends[-1])
     return sep_inds
 
 
@@ -128,16 +225,29 @@ def _get_tick_info(sort_meta, sort_class):
     if sort_meta is None and sort_class is None:
         return None, None
 
-    # first_df = sort_meta.groupby(sort_class, sort=False).first()
-
-    middle_df = sort_meta.groupby(sort_class, sort=False).mean()
-    middle_inds = np.array(middle_df["sort_idx"].values) + 0.5
-    middle_labels = list(middle_df.index.get_level_values(sort_class[0]))
+    starts, ends, labels = _block_bounds(sort_meta, sort_class)
+    middle_inds = (starts + ends) / 2
+    middle_labels = list(labels)
 
     # need to return the location of the tick, the label, and the divider
     return middle_inds, middle_labels
 
 
+def _draw_lines(ax, inds, ax_type="x", **kws):
+    """Like `ax.axvline` (or `ax.axhline` if `ax_type` is "y") at each of `inds`, but
+    as a single LineCollection artist
+    """
+    if ax_type == "x":
+        segments = [[(t, 0), (t, 1)] for t in inds]
+        transform = ax.get_xaxis_transform()
+    else:
+        segments = [[(0, t), (1, t)] for t in inds]
+        transform = ax.get_yaxis_transform()
+    lines = LineCollection(segments, transform=transform, **kws)
+    ax.add_collection(lines, autolim=False)
+    return lines
+
+
 def draw_ticks(
     tick_ax,
     sort_meta=None,
@@ -163,11 +273,15 @@ def draw_ticks(
 
     if tick_ax_border:
         sep_inds = _get_separator_info(sort_meta, sort_class)
-        for t in sep_inds:
-            if ax_type == "x":
-                tick_ax.axvline(t, color="black", linestyle="-", alpha=1, linewidth=2)
-            else:
-                tick_ax.axhline(t, color="black", linestyle="-", alpha=1, linewidth=2)
+        _draw_lines(
+            tick_ax,
+            sep_inds,
+            ax_type=ax_type,
+            color="black",
+            linestyle="-",
+            alpha=1,
+            linewidth=2,
+        )
 
 
 def draw_separators(
@@ -227,15 +341,21 @@ def draw_separators(
 
         if ax_type == "x":
             lims = ax.get_xlim()
-            drawer = ax.axvline
         else:
             lims = ax.get_ylim()
-            drawer = ax.axhline
 
-        # draw the  lines
-        for t in sep_inds:
-            if t not in lims:  # avoid drawing lines on the borders
-                drawer(t - boost, **gridline_kws)
+        # draw the lines, avoiding the borders
+        line_inds = sep_inds[~np.isin(sep_inds, lims)] - boost
+        _draw_lines(ax, line_inds, ax_type=ax_type, **gridline_kws)
+
+
+def _to_categorical(meta):
+    """String columns as categoricals, so that later factorizing and sorting use the
+    integer codes rather than hashing the strings each time"""
+    for col in meta.columns:
+        if meta[col].dtype == object:
+            meta[col] = meta[col].astype("category")
+    return meta
 
 
 def _process_meta(meta, sort_class):
@@ -252,10 +372,11 @@ def _process_meta(meta, sort_class):
             except TypeError:
                 raise TypeError("`sort_class` must be an iterable or string")
     elif isinstance(sort_class, pd.Series) and meta is None:
-        meta = sort_class.to_frame(name=0)
+        meta = _to_categorical(sort_class.to_frame(name=0))
         sort_class = [0]
     elif isinstance(sort_class, list) and meta is None:
         meta = pd.DataFrame({i: elem for i, elem in enumerate(sort_class)})
+        meta = _to_categorical(meta)
         sort_class = list(range(meta.shape[1]))
     elif isinstance(sort_class, np.ndarray) and meta is None:
         meta = pd.DataFrame(sort_class)
@@ -316,6 +437,7 @@ def _item_to_df(item, name, length):
     else:
         raise ValueError(f"{name} must be a pd.Series, np.array, or list.")
 
+    item_meta = _to_categorical(item_meta)
     item = list(item_meta.columns.values)
     return item_meta, item
 
@@ -345,6 +467,36 @@ def _check_sorting_kws(length, meta, sort_class, class_order, item_order, colors
     return meta, sort_class, class_order, item_order, colors
 
 
+def _heatmap(data, ax, cmap="RdBu_r", center=0, vmin=None, vmax=None, cbar=True):
+    """Heatmap drawn directly with a single rasterized pcolormesh, coloured as
+    `sns.heatmap` would be. Spines are removed, but ticks are left as they are"""
+    data = np.ma.masked_invalid(data)
+    if data.count() == 0:  # nothing to set the color range from
+        vmin = 0 if vmin is None else vmin
+        vmax = 1 if vmax is None else vmax
+    if vmin is None:
+        vmin = data.min()
+    if vmax is None:
+        vmax = data.max()
+    cmap = plt.get_cmap(cmap)
+    vrange = max(vmax - center, center - vmin) if center is not None else 0
+    if vrange > 0:
+        # as seaborn does, use the part of a colormap centered on `center` which
+        # spans vmin to vmax
+        lower = (vmin - center + vrange) / (2 * vrange)
+        upper = (vmax - center + vrange) / (2 * vrange)
+        cmap = ListedColormap(cmap(np.linspace(lower, upper, cmap.N)))
+    mesh = ax.pcolormesh(data, cmap=cmap, vmin=vmin, vmax=vmax, rasterized=True)
+    ax.set(xlim=(0, data.shape[1]), ylim=(0, data.shape[0]))
+    ax.invert_yaxis()
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    if cbar:
+        colorbar = ax.figure.colorbar(mesh, ax=ax)
+        colorbar.outline.set_linewidth(0)
+    return mesh
+
+
 def _check_data(data):
     if not isinstance(data, np.ndarray):
         raise TypeError("data must be a np.ndarray.")
@@ -388,6 +540,8 @@ def matrixplot(
     gridline_kws=None,
     spinestyle_kws=None,
     highlight_kws=None,
+    sort_cache=None,
+    rasterized_heatmap=False,
     # dot_color=None,
     **kws,
 ):
@@ -441,6 +595,14 @@ def matrixplot(
         [description], by default None
     tick_rot : int, optional
         [description], by default 0
+    sort_cache : dict, optional
+        a dict owned by the caller in which to remember how each meta was sorted,
+        for plotting with the same meta many times. The meta must not be modified
+        in between, by default None
+    rasterized_heatmap : bool, optional
+        whether to draw a heatmap as one rasterized pcolormesh rather than with
+        `sns.heatmap`, which keeps vector output small for large matrices. Only the
+        vmin, vmax and cbar keywords are supported then, by default False
     
     Returns
     -------
@@ -454,6 +616,18 @@ def matrixplot(
     if plot_type not in plot_type_opts:
         raise ValueError(f"`plot_type` must be one of {plot_type_opts}")
 
+    # adjplot passes the same sorting for rows and columns, so sort once and share it
+    symmetric = data.shape[0] == data.shape[1] and all(
+        row_item is col_item
+        for row_item, col_item in [
+            (row_meta, col_meta),
+            (row_sort_class, col_sort_class),
+            (row_class_order, col_class_order),
+            (row_item_order, col_item_order),
+            (row_colors, col_colors),
+        ]
+    )
+
     row_meta, row_sort_class, row_class_order, row_item_order, row_colors = _check_sorting_kws(
         data.shape[0],
         row_meta,
@@ -463,38 +637,57 @@ def matrixplot(
         row_colors,
     )
 
-    col_meta, col_sort_class, col_class_order, col_item_order, col_colors = _check_sorting_kws(
-        data.shape[1],
-        col_meta,
-        col_sort_class,
-        col_class_order,
-        col_item_order,
-        col_colors,
-    )
+    if symmetric:
+        col_sort_class = row_sort_class
+        col_colors = row_colors
+    else:
+        col_meta, col_sort_class, col_class_order, col_item_order, col_colors = _check_sorting_kws(
+            data.shape[1],
+            col_meta,
+            col_sort_class,
+            col_class_order,
+            col_item_order,
+            col_colors,
+        )
 
     # sort the data and metadata
-    row_perm_inds, row_meta = sort_meta(
+    if sort_cache is not None:
+        sorter = partial(_cached_sort_meta, sort_cache)
+    else:
+        sorter = sort_meta
+    row_perm_inds, row_meta = sorter(
         data.shape[0],
         row_meta,
         row_sort_class,
         class_order=row_class_order,
         sort_item=row_item_order,
     )
-    col_perm_inds, col_meta = sort_meta(
-        data.shape[1],
-        col_meta,
-        col_sort_class,
-        class_order=col_class_order,
-        sort_item=col_item_order,
-    )
-    data = data[np.ix_(row_perm_inds, col_perm_inds)]
+    if symmetric:
+        col_perm_inds, col_meta = row_perm_inds, row_meta
+    else:
+        col_perm_inds, col_meta = sorter(
+            data.shape[1],
+            col_meta,
+            col_sort_class,
+            class_order=col_class_order,
+            sort_item=col_item_order,
+        )
+    # the gather already makes a new C-contiguous array, so skip it if nothing moved
+    if not (
+        np.array_equal(row_perm_inds, np.arange(data.shape[0]))
+        and np.array_equal(col_perm_inds, np.arange(data.shape[1]))
+    ):
+        data = data[np.ix_(row_perm_inds, col_perm_inds)]
 
     # draw the main heatmap/scattermap
     if ax is None:
         _, ax = plt.subplots(1, 1, figsize=(10, 10))
 
     if plot_type == "heatmap":
-        sns.heatmap(data, cmap=cmap, ax=ax, center=center, **kws)
+        if rasterized_heatmap:
+            _heatmap(data, ax, cmap=cmap, center=center, **kws)
+        else:
+            sns.heatmap(data, cmap=cmap, ax=ax, center=center, **kws)
     elif plot_type == "scattermap":
         gridmap(data, ax=ax, sizes=sizes, border=False, **kws)
 
@@ -513,6 +706,9 @@ def matrixplot(
 
     # draw colors
     # note that top_cax and left_cax may = ax if no colors are requested
+    class_colormap = None
+    if symmetric and len(col_colors) > 0 and col_palette is row_palette:
+        class_colormap = _class_colormap(col_meta[col_colors[0]], col_palette)
     top_cax = draw_colors(
         ax,
         divider=divider,
@@ -520,6 +716,7 @@ def matrixplot(
         colors=col_colors,
         palette=col_palette,
         sort_meta=col_meta,
+        class_colormap=class_colormap,
     )
     top_cax.xaxis.set_label_position("top")
 
@@ -530,6 +727,7 @@ def matrixplot(
         colors=row_colors,
         palette=row_palette,
         sort_meta=row_meta,
+        class_colormap=class_colormap,
     )
 
     remove_shared_ax(ax)
@@ -19,7 +19,7 @@ from sklearn.utils import check_array, check_consistent_length
 from graspy.embed import select_dimension, selectSVD
 from graspy.models import SBMEstimator
 from graspy.plot import heatmap
-from graspy.utils import binarize, cartprod
+from graspy.utils import binarize
 from src.utils import get_sbm_prob, savefig
 
 from .manual_colors import CLASS_COLOR_DICT
@@ -869,19 +869,13 @@ def _calculate_block_edgesum(graph, block_inds, block_vert_inds):
     return_counts : whether to calculate counts rather than proportions
     """
 
-    n_blocks = len(block_inds)
-    block_pairs = cartprod(block_inds, block_inds)
-    block_p = np.zeros((n_blocks, n_blocks))
-
-    for p in block_pairs:
-        from_block = p[0]
-        to_block = p[1]
-        from_inds = block_vert_inds[from_block]
-        to_inds = block_vert_inds[to_block]
-        block = graph[from_inds, :][:, to_inds]
-        p = np.sum(block)
-        p = p / block.size
-        block_p[from_block, to_block] = p
+    # order nodes so each block is contiguous, then sum over block boundaries
+    perm = np.concatenate([block_vert_inds[i] for i in block_inds])
+    block_sizes = np.array([len(block_vert_inds[i]) for i in block_inds])
+    starts = np.concatenate(([0], np.cumsum(block_sizes)[:-1]))
+    from_sums = np.add.reduceat(graph[perm], starts, axis=0)
+    block_sums = np.add.reduceat(from_sums[:, perm], starts, axis=1)
+    block_p = block_sums / np.outer(block_sizes, block_sizes)
 
     return block_p
 